@@ -1,6 +1,8 @@
 """class of climate data and functions associated with manipulating the dataset to be in the proper format"""
 
 import os
+import itertools
+from concurrent.futures import ProcessPoolExecutor
 # External libraries
 import pandas as pd
 import numpy as np
@@ -188,7 +190,116 @@ class GCM():
                 self.scenario = scenario
             
             
-    def importGCMfxnearestneighbor_xarray(self, filename, vn, main_glac_rgi):
+    def _nearest_latlon_idx(self, data, main_glac_rgi, nn_cache=None):
+        """
+        Nearest neighbor latitude and longitude indices of the climate grid for each glacier.
+        
+        Parameters
+        ----------
+        data : xarray dataset
+            climate dataset containing the latitude and longitude coordinates
+        main_glac_rgi : pandas dataframe
+            dataframe containing relevant rgi glacier information
+        nn_cache : dict
+            cache of nearest neighbor indices keyed by the grid coordinates (optional)
+        
+        Returns
+        -------
+        lat_nearidx, lon_nearidx : numpy array
+            indices of the nearest latitude and longitude for each glacier
+        """
+        lat_values = data.variables[self.lat_vn][:].values
+        lon_values = data.variables[self.lon_vn][:].values
+        glac_lat = main_glac_rgi[self.rgi_lat_colname].values
+        glac_lon = main_glac_rgi[self.rgi_lon_colname].values
+        if nn_cache is not None:
+            cache_key = (lat_values.tobytes(), lon_values.tobytes(), glac_lat.tobytes(), glac_lon.tobytes())
+            if cache_key in nn_cache:
+                return nn_cache[cache_key]
+        #  argmin() finds the minimum distance between the glacier lat/lon and the GCM pixel; .values is used to 
+        #  extract the position's value as opposed to having an array
+        lat_nearidx = (np.abs(glac_lat[:,np.newaxis] - lat_values).argmin(axis=1))
+        lon_nearidx = (np.abs(glac_lon[:,np.newaxis] - lon_values).argmin(axis=1))
+        if nn_cache is not None:
+            nn_cache[cache_key] = (lat_nearidx, lon_nearidx)
+        return lat_nearidx, lon_nearidx
+    
+    
+    def _latlon_window(self, data, main_glac_rgi, pad=2):
+        """
+        Padded latitude/longitude window of the climate grid that contains all the glaciers.
+        
+        The window is padded by the grid resolution, so the nearest neighbors within the window are the same as those of
+        the full grid, while opening and reading the data is proportional to the region instead of the globe.
+        
+        Parameters
+        ----------
+        data : xarray dataset
+            climate dataset containing the latitude and longitude coordinates
+        main_glac_rgi : pandas dataframe
+            dataframe containing relevant rgi glacier information
+        pad : int
+            number of grid cells used to pad the bounding box of the glaciers
+        
+        Returns
+        -------
+        window : dict
+            dictionary of the latitude and longitude dimensions and their index slices
+        """
+        window = {}
+        for coord_vn, glac_cn in [(self.lat_vn, self.rgi_lat_colname), (self.lon_vn, self.rgi_lon_colname)]:
+            if coord_vn not in data.dims or data[coord_vn].ndim != 1 or data[coord_vn].shape[0] < 2:
+                continue
+            coord_values = data[coord_vn].values
+            coord_res = np.abs(np.diff(coord_values)).max()
+            glac_values = main_glac_rgi[glac_cn].values
+            window_idx = np.where((coord_values >= glac_values.min() - pad * coord_res) & 
+                                  (coord_values <= glac_values.max() + pad * coord_res))[0]
+            if window_idx.shape[0] > 0:
+                window[coord_vn] = slice(window_idx.min(), window_idx.max() + 1)
+        return window
+    
+    
+    def _read_cells(self, data_vn, lat_idx, lon_idx, chunk_nbytes=2**28):
+        """
+        Read the time series of grid cells using chunks of latitude rows.
+        
+        Each chunk reads the block (time, latitude rows, longitude range) of the cells in those rows, so memory is 
+        bounded by chunk_nbytes and data is read from disk in a few large requests instead of one per cell.
+        
+        Parameters
+        ----------
+        data_vn : xarray dataarray
+            lazily loaded variable with dimensions (time, latitude, longitude)
+        lat_idx, lon_idx : numpy array
+            latitude and longitude indices of each cell
+        chunk_nbytes : int
+            approximate maximum number of bytes read in each chunk
+        
+        Returns
+        -------
+        cell_series : numpy array
+            time series of each cell (rows=cells, columns=time series)
+        """
+        cell_series = np.zeros((lat_idx.shape[0], data_vn.shape[0]), dtype=data_vn.dtype)
+        row_nbytes = data_vn.shape[0] * data_vn.shape[2] * data_vn.dtype.itemsize
+        chunk_nrows = max(1, int(chunk_nbytes / row_nbytes))
+        lat_idx_unique = np.unique(lat_idx)
+        nchunk = 0
+        while nchunk < lat_idx_unique.shape[0]:
+            # Chunk of latitude rows
+            row_start = lat_idx_unique[nchunk]
+            row_end = lat_idx_unique[lat_idx_unique < row_start + chunk_nrows].max()
+            cells_idx = np.where((lat_idx >= row_start) & (lat_idx <= row_end))[0]
+            col_start = lon_idx[cells_idx].min()
+            col_end = lon_idx[cells_idx].max()
+            block = data_vn[:, row_start:row_end+1, col_start:col_end+1].values
+            cell_series[cells_idx,:] = block[:, lat_idx[cells_idx] - row_start, lon_idx[cells_idx] - col_start].T
+            nchunk = np.where(lat_idx_unique == row_end)[0][0] + 1
+        return cell_series
+    
+    
+    def importGCMfxnearestneighbor_xarray(self, filename, vn, main_glac_rgi, nn_cache=None):
         """
         Import time invariant (constant) variables and extract nearest neighbor.
         
@@ -202,6 +313,9 @@ class GCM():
             variable name
         main_glac_rgi : pandas dataframe
             dataframe containing relevant rgi glacier information
+        nn_cache : dict
+            cache of nearest neighbor indices keyed by the grid coordinates, which may be shared by GCM objects that 
+            use the same grid (e.g., realizations of a large ensemble)
         
         Returns
         -------
@@ -226,11 +340,9 @@ class GCM():
                 glac_variable[glac] = (
                         data[vn][latlon_nearidx[0], latlon_nearidx[1]].values)
         else:
-            #  argmin() finds the minimum distance between the glacier lat/lon and the GCM pixel
-            lat_nearidx = (np.abs(main_glac_rgi[self.rgi_lat_colname].values[:,np.newaxis] - 
-                                  data.variables[self.lat_vn][:].values).argmin(axis=1))
-            lon_nearidx = (np.abs(main_glac_rgi[self.rgi_lon_colname].values[:,np.newaxis] - 
-                                  data.variables[self.lon_vn][:].values).argmin(axis=1))
+            # Only read the window of the grid surrounding the glaciers
+            data = data.isel(self._latlon_window(data, main_glac_rgi))
+            lat_nearidx, lon_nearidx = self._nearest_latlon_idx(data, main_glac_rgi, nn_cache=nn_cache)
             
             latlon_nearidx = list(zip(lat_nearidx, lon_nearidx))
             latlon_nearidx_unique = list(set(latlon_nearidx))
@@ -260,7 +372,8 @@ class GCM():
         return glac_variable
 
     
-    def importGCMvarnearestneighbor_xarray(self, filename, vn, main_glac_rgi, dates_table, realizations=['r1i1p1f1','r4i1p1f1']):
+    def importGCMvarnearestneighbor_xarray(self, filename, vn, main_glac_rgi, dates_table, realizations=['r1i1p1f1','r4i1p1f1'],
+                                           nn_cache=None):
         """
         Import time series of variables and extract nearest neighbor.
         
@@ -279,6 +392,9 @@ class GCM():
             dataframe containing relevant rgi glacier information
         dates_table: pandas dataframe
             dataframe containing dates of model run
+        nn_cache : dict
+            cache of nearest neighbor indices keyed by the grid coordinates, which may be shared by GCM objects that 
+            use the same grid (e.g., realizations of a large ensemble)
         
         Returns
         -------
@@ -343,26 +459,21 @@ class GCM():
                 glac_variable_series[glac,:] = (
                         data[vn][start_idx:end_idx+1, latlon_nearidx[0], latlon_nearidx[1]].values)
         else:
-            #  argmin() finds the minimum distance between the glacier lat/lon and the GCM pixel; .values is used to 
-            #  extract the position's value as opposed to having an array
-            lat_nearidx = (np.abs(main_glac_rgi[self.rgi_lat_colname].values[:,np.newaxis] - 
-                                  data.variables[self.lat_vn][:].values).argmin(axis=1))
-            lon_nearidx = (np.abs(main_glac_rgi[self.rgi_lon_colname].values[:,np.newaxis] - 
-                                  data.variables[self.lon_vn][:].values).argmin(axis=1))
-            # Find unique latitude/longitudes
-            latlon_nearidx = list(zip(lat_nearidx, lon_nearidx))
-            latlon_nearidx_unique = list(set(latlon_nearidx))
-            # Create dictionary of time series for each unique latitude/longitude
-            glac_variable_dict = {}
-            for latlon in latlon_nearidx_unique:                
-                if 'expver' in data.keys():
-                    expver_idx = 0
-                    glac_variable_dict[latlon] = data[vn][start_idx:end_idx+1, expver_idx, latlon[0], latlon[1]].values
-                else:
-                    glac_variable_dict[latlon] = data[vn][start_idx:end_idx+1, latlon[0], latlon[1]].values
-                
+            # Only read the window of the grid surrounding the glaciers
+            data = data.isel(self._latlon_window(data, main_glac_rgi))
+            lat_nearidx, lon_nearidx = self._nearest_latlon_idx(data, main_glac_rgi, nn_cache=nn_cache)
+            # Select the time series (lazily) over the window
+            if 'expver' in data.keys():
+                expver_idx = 0
+                data_vn = data[vn][start_idx:end_idx+1, expver_idx]
+            else:
+                data_vn = data[vn][start_idx:end_idx+1]
+            # Find unique latitude/longitudes and read their time series in chunks of latitude rows
+            latlon_nearidx = np.column_stack((lat_nearidx, lon_nearidx))
+            latlon_nearidx_unique, latlon_inverse = np.unique(latlon_nearidx, axis=0, return_inverse=True)
+            glac_variable_unique = self._read_cells(data_vn, latlon_nearidx_unique[:,0], latlon_nearidx_unique[:,1])
             # Convert to series
-            glac_variable_series = np.array([glac_variable_dict[x] for x in latlon_nearidx])  
+            glac_variable_series = glac_variable_unique[latlon_inverse.reshape(-1)]
 
         # Perform corrections to the data if necessary
         # Surface air temperature corrections
@@ -399,3 +510,124 @@ class GCM():
         elif vn != self.lr_vn:
             print('Check units of air temperature or precipitation')
         return glac_variable_series, time_series
+
+
+class GCMEnsemble():
+    """
+    Ensemble of GCM realizations and/or models loaded together for all glaciers in the model run.
+    
+    Members that share a grid (e.g., realizations of a large ensemble) share the nearest neighbor computations and 
+    time invariant files, while the time series of each member are read in parallel processes (netCDF/HDF5 reads are 
+    not thread-safe).
+    
+    Attributes
+    ----------
+    names : str or list of str
+        name(s) of climate dataset(s)
+    scenario : str
+        rcp or ssp scenario (example: 'rcp26' or 'ssp585')
+    realizations : list of str
+        realizations from large ensemble (example: ['1011.001', '1301.020']); None for single realization models
+    members : list of GCM
+        one GCM object for each model and realization (ordered by model, then realization)
+    """
+    def __init__(self, 
+                 names=str(),
+                 scenario=str(),
+                 realizations=None):
+        """
+        Create a GCM object for each member of the ensemble.
+        """
+        if isinstance(names, str):
+            names = [names]
+        self.names = list(names)
+        self.scenario = scenario
+        self.realizations = realizations
+        if realizations is None:
+            self.members = [GCM(name=name, scenario=scenario) for name in self.names]
+        else:
+            self.members = [GCM(name=name, scenario=scenario, realization=realization) 
+                            for name, realization in itertools.product(self.names, realizations)]
+        # Nearest neighbor indices shared by all members on the same grid
+        self.nn_cache = {}
+        
+        
+    def importGCMfxnearestneighbor_xarray(self, var, main_glac_rgi):
+        """
+        Import time invariant (constant) variables and extract nearest neighbor for each member.
+        
+        Each unique file is only read once (e.g., the elevation of a large ensemble is shared by all realizations).
+        
+        Parameters
+        ----------
+        var : str
+            variable type used to select the member's filename and variable name (example: 'elev')
+        main_glac_rgi : pandas dataframe
+            dataframe containing relevant rgi glacier information
+        
+        Returns
+        -------
+        ens_variable : numpy array
+            array of nearest neighbor values (rows=members, columns=glaciers)
+        """
+        ens_variable = np.zeros((len(self.members), main_glac_rgi.shape[0]))
+        fx_dict = {}
+        for nmember, member in enumerate(self.members):
+            filename = getattr(member, var + '_fn')
+            vn = getattr(member, var + '_vn')
+            fx_key = (member.fx_fp + filename, vn)
+            if fx_key not in fx_dict:
+                fx_dict[fx_key] = member.importGCMfxnearestneighbor_xarray(filename, vn, main_glac_rgi, 
+                                                                           nn_cache=self.nn_cache)
+            ens_variable[nmember,:] = fx_dict[fx_key]
+        return ens_variable
+    
+    
+    def importGCMvarnearestneighbor_xarray(self, var, main_glac_rgi, dates_table, max_workers=None):
+        """
+        Import time series of variables and extract nearest neighbor for each member using parallel processes.
+        
+        Parameters
+        ----------
+        var : str
+            variable type used to select the member's filename and variable name (example: 'temp' or 'prec')
+        main_glac_rgi : pandas dataframe
+            dataframe containing relevant rgi glacier information
+        dates_table: pandas dataframe
+            dataframe containing dates of model run
+        max_workers : int
+            maximum number of processes used to read the members (default None uses the number of processors); the 
+            members are read one after another with max_workers=1
+        
+        Returns
+        -------
+        ens_variable_series : numpy array
+            array of nearest neighbor values (member, glacier, time) ready for bias adjustment
+        time_series : numpy array
+            array of dates associated with the meteorological data of the first member
+        """
+        # Compute the nearest neighbors of each grid once before reading members in parallel
+        for member in self.members:
+            member_fullfn = member.var_fp + getattr(member, var + '_fn')
+            if os.path.exists(member_fullfn):
+                with xr.open_dataset(member_fullfn) as data:
+                    data = data.isel(member._latlon_window(data, main_glac_rgi))
+                    member._nearest_latlon_idx(data, main_glac_rgi, nn_cache=self.nn_cache)
+        
+        read_args = (self.members, itertools.repeat(var), itertools.repeat(main_glac_rgi), 
+                     itertools.repeat(dates_table), itertools.repeat(self.nn_cache))
+        if max_workers == 1 or len(self.members) == 1:
+            member_output = list(map(_import_member, *read_args))
+        else:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                member_output = list(executor.map(_import_member, *read_args))
+        
+        ens_variable_series = np.stack([x[0] for x in member_output], axis=0)
+        time_series = member_output[0][1]
+        return ens_variable_series, time_series
+
+
+def _import_member(member, var, main_glac_rgi, dates_table, nn_cache):
+    """ Time series of a variable of one ensemble member (see GCMEnsemble.importGCMvarnearestneighbor_xarray) """
+    return member.importGCMvarnearestneighbor_xarray(getattr(member, var + '_fn'), getattr(member, var + '_vn'),
+                                                     main_glac_rgi, dates_table, nn_cache=nn_cache)
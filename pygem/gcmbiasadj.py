@@ -3,12 +3,15 @@
 # Built-in libraries
 import os
 import sys
-import math
+import json
+import hashlib
+import itertools
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing import shared_memory
 
 # External libraries
 import numpy as np
-from scipy.ndimage import uniform_filter
-from scipy.stats import percentileofscore
+from scipy.ndimage import uniform_filter1d
 
 try:
     import pygem
@@ -47,9 +50,116 @@ def monthly_std_2darray(x):
     """
     return x.reshape(-1,12).transpose().reshape(-1,int(x.shape[1]/12)).std(1).reshape(12,-1).transpose()
 
+
+def unique_glacier_rows(*arrays):
+    """
+    Unique rows shared by glaciers for the given (glaciers, months) arrays
+    
+    Glaciers in the same gcm and reference climate cells have identical rows, so bias adjustments only need to be 
+    computed once for each unique row and then scattered back to the glaciers.
+    
+    Returns
+    -------
+    unique_idx : np.array
+        index of the first glacier with each unique row
+    unique_inverse : np.array
+        index of the unique row for each glacier, i.e., array[unique_idx][unique_inverse] == array
+    """
+    arrays = [np.asarray(x, dtype=float) for x in arrays]
+    # hash each row using a random projection, so only one value per glacier needs to be sorted
+    rng = np.random.default_rng(0)
+    rows_hash = np.zeros(arrays[0].shape[0])
+    for x in arrays:
+        rows_hash += x @ rng.standard_normal(x.shape[1])
+    _, unique_idx, unique_inverse = np.unique(rows_hash, return_index=True, return_inverse=True)
+    unique_inverse = unique_inverse.reshape(-1)
+    # verify the rows are identical, otherwise compare the full rows (e.g., hash collisions or nan values)
+    if not all([np.array_equal(x[unique_idx][unique_inverse], x) for x in arrays]):
+        rows = np.ascontiguousarray(np.concatenate(arrays, axis=1))
+        rows_void = rows.view(np.dtype((np.void, rows.dtype.itemsize * rows.shape[1]))).reshape(-1)
+        _, unique_idx, unique_inverse = np.unique(rows_void, return_index=True, return_inverse=True)
+        unique_inverse = unique_inverse.reshape(-1)
+    return unique_idx, unique_inverse
+
+
+def percentileofscore_2darray(x):
+    """
+    Percentile of each value relative to all values in the same row (rank-based)
+    
+    Equivalent to scipy.stats.percentileofscore(x[i,:], x[i,j], kind='rank') for every value, but each row is only 
+    sorted once and ties are resolved from the sorted rows.
+    """
+    nvalues = x.shape[1]
+    sort_idx = np.argsort(x, axis=1, kind='stable')
+    x_sorted = np.take_along_axis(x, sort_idx, axis=1)
+    positions = np.broadcast_to(np.arange(nvalues), x.shape)
+    # number of values strictly less than each value (position of the first of its ties)
+    tie_first = np.ones(x.shape, dtype=bool)
+    tie_first[:,1:] = x_sorted[:,1:] != x_sorted[:,:-1]
+    nless = np.maximum.accumulate(np.where(tie_first, positions, 0), axis=1)
+    # number of values less than or equal to each value (position after the last of its ties)
+    tie_last = np.ones(x.shape, dtype=bool)
+    tie_last[:,:-1] = x_sorted[:,:-1] != x_sorted[:,1:]
+    nlessequal = np.minimum.accumulate(np.where(tie_last, positions + 1, nvalues)[:,::-1], axis=1)[:,::-1]
+    # 'rank' percentile, which adds one since each value is always counted in its own row
+    percentile_xsorted = (nless + nlessequal + 1) * (50.0 / nvalues)
+    percentile = np.empty(x.shape)
+    np.put_along_axis(percentile, sort_idx, percentile_xsorted, axis=1)
+    return percentile
+
+
+def percentile_sorted(x_sorted, percentile):
+    """
+    Linearly interpolated percentiles of a sorted 1d array, equivalent to np.percentile(x, percentile)
+    """
+    return np.interp(percentile / 100 * (x_sorted.shape[0] - 1), np.arange(x_sorted.shape[0]), x_sorted)
+
+
+def qdm_adjust(bc_data, ref_data, gcm_data, loop_months):
+    """
+    Quantile delta mapping of a (glaciers, months) array using periods of loop_months
+    
+    The percentile of each value is computed relative to the values of the same glacier and period, and the value is 
+    multiplied by the ratio of the reference and historic gcm data at that percentile. All glaciers and periods are 
+    processed at once; the last period may be shorter if the time series is not a multiple of loop_months.
+    
+    Parameters
+    ----------
+    bc_data : np.array
+        time series of GCM data to be bias-corrected (rows=glaciers, columns=months)
+    ref_data : np.array
+        reference climate data over the calibration period (all values are used for the quantile function)
+    gcm_data : np.array
+        historic GCM data over the calibration period (all values are used for the quantile function)
+    loop_months : int
+        number of months used for each bias-correction period
+    
+    Returns
+    -------
+    bc_data_biasadj : np.array
+        bias-corrected GCM data
+    """
+    ref_sorted = np.sort(ref_data, axis=None)
+    gcm_sorted = np.sort(gcm_data, axis=None)
+    # quantile functions use all glaciers, so only the gcm data to be corrected needs to be unique
+    unique_idx, unique_inverse = unique_glacier_rows(bc_data)
+    bc_data = bc_data[unique_idx]
+    bc_data_biasadj = np.zeros(bc_data.shape)
+    # full periods and the remaining (shorter) period
+    full_end = int(bc_data.shape[1] / loop_months) * loop_months
+    for period_start, period_end, period_months in [(0, full_end, loop_months), 
+                                                    (full_end, bc_data.shape[1], bc_data.shape[1] - full_end)]:
+        if period_end > period_start:
+            bc_periods = bc_data[:,period_start:period_end].reshape(-1, period_months)
+            percentile = percentileofscore_2darray(bc_periods)
+            bias_correction_factor = percentile_sorted(ref_sorted, percentile) / percentile_sorted(gcm_sorted, percentile)
+            bc_data_biasadj[:,period_start:period_end] = (
+                    (bc_periods * bias_correction_factor).reshape(bc_data.shape[0], -1))
+    return bc_data_biasadj[unique_inverse]
+
     
 def temp_biasadj_HH2015(ref_temp, ref_elev, gcm_temp, dates_table_ref, dates_table, 
-                        ref_spinupyears=0, gcm_spinupyears=0, debug=False):
+                        ref_spinupyears=0, gcm_spinupyears=0, glac_chunk_size=None, debug=False):
     """
     Huss and Hock (2015) temperature bias correction based on mean and interannual variability
     
@@ -67,6 +177,8 @@ def temp_biasadj_HH2015(ref_temp, ref_elev, gcm_temp, dates_table_ref, dates_tab
         dates table for reference time period
     dates_table : pd.DataFrame
         dates_table for GCM time period
+    glac_chunk_size : int
+        number of glaciers processed at once by the running mean; if None, all glaciers are processed at once
     
     Returns
     -------
@@ -75,6 +187,15 @@ def temp_biasadj_HH2015(ref_temp, ref_elev, gcm_temp, dates_table_ref, dates_tab
     gcm_elev_biasadj : float
         new gcm elevation is the elevation of the reference climate dataset
     """
+    # Glaciers that share the same gcm and reference cells have the same adjustment, so compute unique rows only
+    unique_idx, unique_inverse = unique_glacier_rows(ref_temp, gcm_temp)
+    if unique_idx.shape[0] < ref_temp.shape[0]:
+        gcm_temp_biasadj, gcm_elev_biasadj = temp_biasadj_HH2015(
+                ref_temp[unique_idx], ref_elev, gcm_temp[unique_idx], dates_table_ref, dates_table,
+                ref_spinupyears=ref_spinupyears, gcm_spinupyears=gcm_spinupyears, glac_chunk_size=glac_chunk_size,
+                debug=debug)
+        return gcm_temp_biasadj[unique_inverse], gcm_elev_biasadj
+    
     # GCM subset to agree with reference time period to calculate bias corrections
     gcm_subset_idx_start = np.where(dates_table.date.values == dates_table_ref.date.values[0])[0][0]
     gcm_subset_idx_end = np.where(dates_table.date.values == dates_table_ref.date.values[-1])[0][0]
@@ -119,19 +240,27 @@ def temp_biasadj_HH2015(ref_temp, ref_elev, gcm_temp, dates_table_ref, dates_tab
     #   This is where the actual bias adjustment of temperature values occurs.
     #   All steps before this are preliminary steps (e.g., formatting,
     #   determining additive factor and std adjustment).
-    t_mt = bc_temp + np.tile(gcm_temp_monthly_adj, int(bc_temp.shape[1]/12))
+    #   Arrays are reshaped to (glacier, year, month), so monthly values broadcast over the years
+    t_mt = bc_temp.reshape(bc_temp.shape[0],-1,12) + gcm_temp_monthly_adj[:,np.newaxis,:]
     
     # Mean monthly temperature bias adjusted according to monthly average
     #  t_m25avg is the avg monthly temp in a 25-year period around the given year
+    #  the running average is computed along the year axis for all months at once and for chunks of glaciers,
+    #  so only one chunk of the running average is held in memory
     N = 25
-    t_m_Navg = np.zeros(t_mt.shape)
-    for month in range(0,12):
-        t_m_subset = t_mt[:,month::12]
+    if glac_chunk_size is None:
+        glac_chunk_size = t_mt.shape[0]
+    t_m_Navg = np.zeros((min(glac_chunk_size, t_mt.shape[0]),) + t_mt.shape[1:])
+    for glac_start in range(0, t_mt.shape[0], glac_chunk_size):
+        t_mt_chunk = t_mt[glac_start:glac_start+glac_chunk_size]
+        t_m_Navg_chunk = t_m_Navg[:t_mt_chunk.shape[0]]
         # Uniform filter computes running average and uses 'reflects' values at borders
-        t_m_Navg_subset = uniform_filter(t_m_subset,size=(1,N))
-        t_m_Navg[:,month::12] = t_m_Navg_subset
-
-    gcm_temp_biasadj = t_m_Navg + (t_mt - t_m_Navg) * np.tile(variability_monthly_std, int(bc_temp.shape[1]/12))
+        uniform_filter1d(t_mt_chunk, size=N, axis=1, mode='reflect', output=t_m_Navg_chunk)
+        # Adjust variability in place: t_m_Navg + (t_mt - t_m_Navg) * variability_monthly_std
+        t_mt_chunk -= t_m_Navg_chunk
+        t_mt_chunk *= variability_monthly_std[glac_start:glac_start+glac_chunk_size,np.newaxis,:]
+        t_mt_chunk += t_m_Navg_chunk
+    gcm_temp_biasadj = t_mt.reshape(bc_temp.shape)
     
     # Update elevation
     gcm_elev_biasadj = ref_elev
@@ -176,6 +305,14 @@ def prec_biasadj_HH2015(ref_prec, ref_elev, gcm_prec, dates_table_ref, dates_tab
     gcm_prec_biasadj : np.array
         GCM precipitation bias corrected to the reference climate dataset according to Huss and Hock (2015)
     """
+    # Glaciers that share the same gcm and reference cells have the same adjustment, so compute unique rows only
+    unique_idx, unique_inverse = unique_glacier_rows(ref_prec, gcm_prec)
+    if unique_idx.shape[0] < ref_prec.shape[0]:
+        gcm_prec_biasadj, gcm_elev_biasadj = prec_biasadj_HH2015(
+                ref_prec[unique_idx], ref_elev, gcm_prec[unique_idx], dates_table_ref, dates_table,
+                ref_spinupyears=ref_spinupyears, gcm_spinupyears=gcm_spinupyears)
+        return gcm_prec_biasadj[unique_inverse], gcm_elev_biasadj
+    
     # GCM subset to agree with reference time period to calculate bias corrections
     gcm_subset_idx_start = np.where(dates_table.date.values == dates_table_ref.date.values[0])[0][0]
     gcm_subset_idx_end = np.where(dates_table.date.values == dates_table_ref.date.values[-1])[0][0]
@@ -208,7 +345,8 @@ def prec_biasadj_HH2015(ref_prec, ref_elev, gcm_prec, dates_table_ref, dates_tab
         bc_prec = gcm_prec[:,sim_idx_start:]
     
     # Bias adjusted precipitation accounting for differences in monthly mean
-    gcm_prec_biasadj = bc_prec * np.tile(bias_adj_prec_monthly, int(bc_prec.shape[1]/12))
+    gcm_prec_biasadj = (bc_prec.reshape(bc_prec.shape[0],-1,12) * bias_adj_prec_monthly[:,np.newaxis,:]
+                        ).reshape(bc_prec.shape)
     
     # Update elevation
     gcm_elev_biasadj = ref_elev
@@ -248,6 +386,14 @@ def prec_biasadj_opt1(ref_prec, ref_elev, gcm_prec, dates_table_ref, dates_table
     gcm_elev_biasadj : float
         new gcm elevation is the elevation of the reference climate dataset
     """
+    # Glaciers that share the same gcm and reference cells have the same adjustment, so compute unique rows only
+    unique_idx, unique_inverse = unique_glacier_rows(ref_prec, gcm_prec)
+    if unique_idx.shape[0] < ref_prec.shape[0]:
+        gcm_prec_biasadj, gcm_elev_biasadj = prec_biasadj_opt1(
+                ref_prec[unique_idx], ref_elev, gcm_prec[unique_idx], dates_table_ref, dates_table,
+                ref_spinupyears=ref_spinupyears, gcm_spinupyears=gcm_spinupyears)
+        return gcm_prec_biasadj[unique_inverse], gcm_elev_biasadj
+    
     # GCM subset to agree with reference time period to calculate bias corrections
     gcm_subset_idx_start = np.where(dates_table.date.values == dates_table_ref.date.values[0])[0][0]
     gcm_subset_idx_end = np.where(dates_table.date.values == dates_table_ref.date.values[-1])[0][0]
@@ -280,39 +426,37 @@ def prec_biasadj_opt1(ref_prec, ref_elev, gcm_prec, dates_table_ref, dates_table
         bc_prec = gcm_prec[:,sim_idx_start:]
     
     # Bias adjusted precipitation accounting for differences in monthly mean
-    gcm_prec_biasadj_raw = bc_prec * np.tile(bias_adj_prec_monthly, int(bc_prec.shape[1]/12))
+    #   Arrays are reshaped to (glacier, year, month), so monthly values broadcast over the years
+    gcm_prec_biasadj = bc_prec.reshape(bc_prec.shape[0],-1,12) * bias_adj_prec_monthly[:,np.newaxis,:]
     
     # Adjust variance based on zscore and reference standard deviation
     ref_prec_monthly_std = np.roll(monthly_std_2darray(ref_prec_nospinup), roll_amt, axis=1)
-    gcm_prec_biasadj_raw_monthly_avg = monthly_avg_2darray(gcm_prec_biasadj_raw[:,0:ref_prec.shape[1]])
-    gcm_prec_biasadj_raw_monthly_std = monthly_std_2darray(gcm_prec_biasadj_raw[:,0:ref_prec.shape[1]])
-    # Calculate value compared to mean and standard deviation
-    gcm_prec_biasadj_zscore = (
-            (gcm_prec_biasadj_raw - np.tile(gcm_prec_biasadj_raw_monthly_avg, int(bc_prec.shape[1]/12))) / 
-             np.tile(gcm_prec_biasadj_raw_monthly_std, int(bc_prec.shape[1]/12)))
-    gcm_prec_biasadj = (
-            np.tile(gcm_prec_biasadj_raw_monthly_avg, int(bc_prec.shape[1]/12)) +
-            gcm_prec_biasadj_zscore * np.tile(ref_prec_monthly_std, int(bc_prec.shape[1]/12)))
+    gcm_prec_biasadj_raw_monthly_avg = monthly_avg_2darray(
+            gcm_prec_biasadj.reshape(bc_prec.shape)[:,0:ref_prec.shape[1]])
+    gcm_prec_biasadj_raw_monthly_std = monthly_std_2darray(
+            gcm_prec_biasadj.reshape(bc_prec.shape)[:,0:ref_prec.shape[1]])
+    # Calculate value compared to mean and standard deviation (zscore) and rescale to the reference in place
+    gcm_prec_biasadj -= gcm_prec_biasadj_raw_monthly_avg[:,np.newaxis,:]
+    gcm_prec_biasadj /= gcm_prec_biasadj_raw_monthly_std[:,np.newaxis,:]
+    gcm_prec_biasadj *= ref_prec_monthly_std[:,np.newaxis,:]
+    gcm_prec_biasadj += gcm_prec_biasadj_raw_monthly_avg[:,np.newaxis,:]
     gcm_prec_biasadj[gcm_prec_biasadj < 0] = 0
     
     # Identify outliers using reference's monthly maximum adjusted for future increases
     ref_prec_monthly_max = np.roll((ref_prec_nospinup.reshape(-1,12).transpose()
                                     .reshape(-1,int(ref_prec_nospinup.shape[1]/12)).max(1).reshape(12,-1).transpose()), 
                                    roll_amt, axis=1)
-    gcm_prec_max_check = np.tile(ref_prec_monthly_max, int(gcm_prec_biasadj.shape[1]/12))        
     # For wetter years in future, adjust monthly max by the annual increase in precipitation
     gcm_prec_annual = annual_sum_2darray(bc_prec)
     gcm_prec_annual_norm = gcm_prec_annual / gcm_prec_annual.mean(1)[:,np.newaxis]
-    gcm_prec_annual_norm_repeated = np.repeat(gcm_prec_annual_norm, 12).reshape(gcm_prec_biasadj.shape)
-    gcm_prec_max_check_adj = gcm_prec_max_check * gcm_prec_annual_norm_repeated
-    gcm_prec_max_check_adj[gcm_prec_max_check_adj < gcm_prec_max_check] = (
-            gcm_prec_max_check[gcm_prec_max_check_adj < gcm_prec_max_check])
+    gcm_prec_max_check_adj = ref_prec_monthly_max[:,np.newaxis,:] * gcm_prec_annual_norm[:,:,np.newaxis]
+    np.maximum(gcm_prec_max_check_adj, ref_prec_monthly_max[:,np.newaxis,:], out=gcm_prec_max_check_adj)
     
     # Replace outliers with monthly mean adjusted for the normalized annual variation
-    outlier_replacement = (gcm_prec_annual_norm_repeated * 
-                           np.tile(ref_prec_monthly_avg, int(gcm_prec_biasadj.shape[1]/12)))
-    gcm_prec_biasadj[gcm_prec_biasadj > gcm_prec_max_check_adj] = (
-            outlier_replacement[gcm_prec_biasadj > gcm_prec_max_check_adj])
+    glac_idx, year_idx, month_idx = np.nonzero(gcm_prec_biasadj > gcm_prec_max_check_adj)
+    gcm_prec_biasadj[glac_idx, year_idx, month_idx] = (gcm_prec_annual_norm[glac_idx, year_idx] * 
+                                                       ref_prec_monthly_avg[glac_idx, month_idx])
+    gcm_prec_biasadj = gcm_prec_biasadj.reshape(bc_prec.shape)
     
     # Update elevation
     gcm_elev_biasadj = ref_elev
@@ -387,46 +531,12 @@ def temp_biasadj_QDM(ref_temp, ref_elev, gcm_temp, dates_table_ref, dates_table,
         sim_idx_start = dates_table[dates_cn].to_list().index(pygem_prms.gcm_startyear)
         bc_temp = gcm_temp[:,sim_idx_start:]
     
-    # create an empty array for the bias-corrected GCM data
-    # gcm_temp_biasadj = np.zeros(bc_temp.size)
     loop_years = 20 # number of years used for each bias-correction period
     loop_months = loop_years * 12 # number of months used for each bias-correction period
     
-    # convert to Kelvin to better handle Celsius values around 0)
-    bc_temp = bc_temp + 273.15
-    # bc_temp = bc_temp[0]
-    all_gcm_temp_biasadj =[] # empty list for all glaciers
-    
-    for j in range(0, len(bc_temp)):
-        gcm_temp_biasadj = [] # empty list for bias-corrected data
-        bc_loops = len(bc_temp[j])/loop_months # determine number of loops needed for bias-correction
-        
-        # loop through however many times are required to bias-correct the entire time period
-        #   using smaller time periods (typically 20-30 years) to better capture the
-        #   quantiles and extremes at different points in the future
-        for i in range(0, math.ceil(bc_loops)): 
-            bc_temp_loop = bc_temp[j][i*loop_months:(i+1)*loop_months]
-            bc_temp_loop_corrected = np.zeros(bc_temp_loop.size)
-            
-            # now loop through each individual value within the time period for bias correction        
-            for ival, projected_value in enumerate(bc_temp_loop):
-                percentile = percentileofscore(bc_temp_loop, projected_value) 
-                bias_correction_factor = np.percentile(ref_temp_nospinup, percentile)/np.percentile(gcm_temp_nospinup, percentile)
-                bc_temp_loop_corrected[ival] = projected_value * bias_correction_factor
-            # append the values from each time period to a list               
-            gcm_temp_biasadj.append(bc_temp_loop_corrected)
-
-        gcm_temp_biasadj = np.concatenate(gcm_temp_biasadj, axis=0)
-        # convert back to Celsius for simulation
-        gcm_temp_biasadj = gcm_temp_biasadj - 273.15
-        # gcm_temp_biasadj = np.array([gcm_temp_biasadj.tolist()])
-        all_gcm_temp_biasadj.append(gcm_temp_biasadj)   
-        # print(all_gcm_temp_biasadj)
-        
-    gcm_temp_biasadj = np.array(all_gcm_temp_biasadj)
-    # print(gcm_temp_biasadj[0])
-    # print(gcm_temp_biasadj[1])
-    # print(gcm_temp_biasadj)
+    # convert to Kelvin to better handle Celsius values around 0, bias-correct all glaciers and time periods at once,
+    #   and convert back to Celsius for simulation
+    gcm_temp_biasadj = qdm_adjust(bc_temp + 273.15, ref_temp_nospinup, gcm_temp_nospinup, loop_months) - 273.15
     
     # Update elevation
     gcm_elev_biasadj = ref_elev
@@ -493,38 +603,11 @@ def prec_biasadj_QDM(ref_prec, ref_elev, gcm_prec, dates_table_ref, dates_table,
         sim_idx_start = dates_table[dates_cn].to_list().index(pygem_prms.gcm_startyear)
         bc_prec = gcm_prec[:,sim_idx_start:]
         
-    # create an empty array for the bias-corrected GCM data
-    # gcm_prec_biasadj = np.zeros(bc_prec.size)
     loop_years = 20 # number of years used for each bias-correction period
     loop_months = loop_years * 12 # number of months used for each bias-correction period
     
-    # bc_prec = bc_prec[0]
-    all_gcm_prec_biasadj =[] # empty list for all glaciers
-    
-    for j in range(0, len(bc_prec)):
-        gcm_prec_biasadj = [] # empty list for bias-corrected data
-        bc_loops = len(bc_prec[j])/loop_months # determine number of loops needed for bias-correction
-        
-        # loop through however many times are required to bias-correct the entire time period
-        #   using smaller time periods (typically 20-30 years) to better capture the
-        #   quantiles and extremes at different points in the future
-        for i in range(0, math.ceil(bc_loops)):
-            bc_prec_loop = bc_prec[j][i*loop_months:(i+1)*loop_months]
-            bc_prec_loop_corrected = np.zeros(bc_prec_loop.size)
-            
-            # now loop through each individual value within the time period for bias correction
-            for ival, projected_value in enumerate(bc_prec_loop):
-                percentile = percentileofscore(bc_prec_loop, projected_value) 
-                bias_correction_factor = np.percentile(ref_prec_nospinup, percentile)/np.percentile(gcm_prec_nospinup, percentile)
-                bc_prec_loop_corrected[ival] = projected_value * bias_correction_factor   
-            # append the values from each time period to a list
-            gcm_prec_biasadj.append(bc_prec_loop_corrected)
-            
-        gcm_prec_biasadj = np.concatenate(gcm_prec_biasadj, axis=0)
-        # gcm_prec_biasadj = np.array([gcm_prec_biasadj.tolist()])
-        all_gcm_prec_biasadj.append(gcm_prec_biasadj)
-        
-    gcm_prec_biasadj = np.array(all_gcm_prec_biasadj)
+    # bias-correct all glaciers and time periods at once
+    gcm_prec_biasadj = qdm_adjust(bc_prec, ref_prec_nospinup, gcm_prec_nospinup, loop_months)
     
     # Update elevation
     gcm_elev_biasadj = ref_elev
@@ -555,17 +638,219 @@ def monthly_avg_array_rolled(ref_array, dates_table_ref, dates_table):
     # Roll months so they are aligned with simulation months
     roll_amt = -1*(12 - gcm_subset_idx_start%12)
     ref_array_monthly_avg = np.roll(monthly_avg_2darray(ref_array), roll_amt, axis=1)
-    gcm_array = np.tile(ref_array_monthly_avg, int(dates_table.shape[0]/12))
     
     # if/else statement for whether or not the full GCM period is the same as the simulation period
     #   create GCM subset for applying bias-correction (e.g., 2000-2100),
     #   that does not include the earlier reference years (e.g., 1981-2000)
+    sim_idx_start = 0
     if pygem_prms.gcm_startyear != pygem_prms.gcm_bc_startyear:
         if pygem_prms.gcm_wateryear == 'hydro':
             dates_cn = 'wateryear'
         else:
             dates_cn = 'year'
         sim_idx_start = dates_table[dates_cn].to_list().index(pygem_prms.gcm_startyear)
-        gcm_array = gcm_array[:,sim_idx_start:]
     
-    return gcm_array
\ No newline at end of file
+    # Repeat the monthly averages over the simulation months only
+    nmonths = int(dates_table.shape[0]/12) * 12
+    gcm_array = ref_array_monthly_avg[:,np.arange(sim_idx_start, nmonths) % 12]
+    
+    return gcm_array
+
+
+def biasadj_cache_key(biasadj_fxn, ref_data, gcm_data, dates_table_ref, dates_table, cache_info=None, **kwargs):
+    """
+    Content-addressed key of a bias adjustment
+    
+    The key is a hash of the bias adjustment function, the climate data (which identifies the cells), the dates, the 
+    keyword arguments, the bias adjustment options from pygem_input, and any descriptive inputs in cache_info 
+    (e.g., gcm_name, scenario, realization, and reference dataset).
+    """
+    key_info = {'function': biasadj_fxn.__name__,
+                'kwargs': kwargs,
+                'cache_info': cache_info,
+                'option_bias_adjustment': getattr(pygem_prms, 'option_bias_adjustment', None),
+                'gcm_startyear': pygem_prms.gcm_startyear,
+                'gcm_bc_startyear': pygem_prms.gcm_bc_startyear,
+                'gcm_wateryear': pygem_prms.gcm_wateryear}
+    key_hash = hashlib.sha256(json.dumps(key_info, sort_keys=True, default=str).encode())
+    for data in [ref_data, gcm_data]:
+        data = np.ascontiguousarray(data)
+        key_hash.update(str((data.shape, data.dtype.str)).encode())
+        key_hash.update(data.tobytes())
+    for dates in [dates_table_ref, dates_table]:
+        key_hash.update(dates['date'].values.astype('datetime64[s]').tobytes())
+    return key_hash.hexdigest()
+
+
+def biasadj_cached(biasadj_fxn, ref_data, ref_elev, gcm_data, dates_table_ref, dates_table, 
+                   cache_fp=None, cache_info=None, **kwargs):
+    """
+    Bias adjustment with an optional cache of the bias-adjusted climate data on disk
+    
+    Bias-adjusted data are stored as binary .npy files named by their content-addressed key (see biasadj_cache_key), 
+    so reruns with the same inputs (e.g., calibration reruns or other sim_iters batches) skip the bias adjustment.
+    
+    Parameters
+    ----------
+    biasadj_fxn : function
+        bias adjustment function (e.g., temp_biasadj_HH2015 or prec_biasadj_opt1)
+    ref_data : np.array
+        time series of reference climate data
+    ref_elev : np.array
+        elevation of the reference climate dataset
+    gcm_data : np.array
+        time series of GCM climate data
+    dates_table_ref : pd.DataFrame
+        dates table for reference time period
+    dates_table : pd.DataFrame
+        dates_table for GCM time period
+    cache_fp : str
+        filepath of the cache; if None, the bias adjustment is computed without caching
+    cache_info : dict
+        descriptive inputs included in the key (e.g., {'gcm_name':gcm_name, 'scenario':scenario})
+    **kwargs
+        keyword arguments passed to biasadj_fxn (e.g., ref_spinupyears, gcm_spinupyears)
+    
+    Returns
+    -------
+    gcm_data_biasadj : np.array
+        GCM climate data bias corrected to the reference climate dataset
+    gcm_elev_biasadj : float
+        new gcm elevation is the elevation of the reference climate dataset
+    """
+    if cache_fp is None:
+        return biasadj_fxn(ref_data, ref_elev, gcm_data, dates_table_ref, dates_table, **kwargs)
+    
+    cache_key = biasadj_cache_key(biasadj_fxn, ref_data, gcm_data, dates_table_ref, dates_table, 
+                                  cache_info=cache_info, **kwargs)
+    cache_fullfn = os.path.join(cache_fp, cache_key + '.npy')
+    if os.path.exists(cache_fullfn):
+        gcm_data_biasadj = np.load(cache_fullfn)
+        gcm_elev_biasadj = ref_elev
+    else:
+        gcm_data_biasadj, gcm_elev_biasadj = biasadj_fxn(ref_data, ref_elev, gcm_data, dates_table_ref, dates_table, 
+                                                         **kwargs)
+        # write to a temporary file first, so simultaneous jobs never read a partially written file
+        os.makedirs(cache_fp, exist_ok=True)
+        cache_fullfn_tmp = cache_fullfn.replace('.npy', '-' + str(os.getpid()) + '.tmp.npy')
+        np.save(cache_fullfn_tmp, gcm_data_biasadj)
+        os.replace(cache_fullfn_tmp, cache_fullfn)
+    return gcm_data_biasadj, gcm_elev_biasadj
+
+
+# Shared memory arrays attached by the bias adjustment worker processes
+_biasadj_shared = {}
+
+
+def _biasadj_worker_init(shm_specs, dates_table_ref, dates_table):
+    """ Attach the shared memory arrays and dates tables in a bias adjustment worker process """
+    for vn, (shm_name, shape, dtype) in shm_specs.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        _biasadj_shared[vn] = (shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+    _biasadj_shared['dates_table_ref'] = dates_table_ref
+    _biasadj_shared['dates_table'] = dates_table
+
+
+def _biasadj_chunk(member_idx, glac_start, glac_end, temp_biasadj_fxn, prec_biasadj_fxn, ref_elev, 
+                   ref_spinupyears, gcm_spinupyears):
+    """ Temperature and precipitation bias adjustment of one ensemble member and chunk of glaciers """
+    dates_table_ref = _biasadj_shared['dates_table_ref']
+    dates_table = _biasadj_shared['dates_table']
+    ref_temp = _biasadj_shared['ref_temp'][1][glac_start:glac_end]
+    ref_prec = _biasadj_shared['ref_prec'][1][glac_start:glac_end]
+    gcm_temp = _biasadj_shared['gcm_temp'][1][member_idx, glac_start:glac_end]
+    gcm_prec = _biasadj_shared['gcm_prec'][1][member_idx, glac_start:glac_end]
+    gcm_temp_biasadj, gcm_elev_biasadj = temp_biasadj_fxn(ref_temp, ref_elev, gcm_temp, dates_table_ref, dates_table,
+                                                          ref_spinupyears=ref_spinupyears, 
+                                                          gcm_spinupyears=gcm_spinupyears)
+    gcm_prec_biasadj, gcm_elev_biasadj = prec_biasadj_fxn(ref_prec, ref_elev, gcm_prec, dates_table_ref, dates_table,
+                                                          ref_spinupyears=ref_spinupyears, 
+                                                          gcm_spinupyears=gcm_spinupyears)
+    return member_idx, glac_start, glac_end, gcm_temp_biasadj, gcm_prec_biasadj, gcm_elev_biasadj
+
+
+def biasadj_ensemble(ref_temp, ref_prec, ref_elev, gcm_temp, gcm_prec, dates_table_ref, dates_table,
+                     temp_biasadj_fxn=temp_biasadj_HH2015, prec_biasadj_fxn=prec_biasadj_opt1,
+                     ref_spinupyears=0, gcm_spinupyears=0, glac_chunk_size=500, max_workers=None):
+    """
+    Bias adjustment of an ensemble of GCM/scenario/realization members in parallel chunks of glaciers
+    
+    The climate data are placed in shared memory once and the members are split into chunks of glaciers, which are 
+    bias adjusted in a pool of processes. Adjusted chunks are yielded as they are completed and at most two chunks per 
+    worker are in progress at once, so memory use does not grow with the size of the ensemble.
+    
+    The quantile delta mapping functions (temp_biasadj_QDM, prec_biasadj_QDM) pool the quantile functions over all 
+    glaciers, so with these functions all glaciers of a member are adjusted at once (glac_chunk_size is ignored) to
+    reproduce their serial results.
+    
+    Parameters
+    ----------
+    ref_temp, ref_prec : np.array
+        time series of reference temperature and precipitation (rows=glaciers, columns=months)
+    ref_elev : np.array or float
+        elevation of the reference climate dataset of each glacier (or of all glaciers)
+    gcm_temp, gcm_prec : np.array
+        time series of GCM temperature and precipitation (member, glacier, month), e.g., from 
+        GCMEnsemble.importGCMvarnearestneighbor_xarray
+    dates_table_ref : pd.DataFrame
+        dates table for reference time period
+    dates_table : pd.DataFrame
+        dates_table for GCM time period
+    temp_biasadj_fxn, prec_biasadj_fxn : function
+        temperature and precipitation bias adjustment functions
+    glac_chunk_size : int
+        number of glaciers bias adjusted in each task; if None, all glaciers are adjusted at once
+    max_workers : int
+        number of processes (default is the number of cpus)
+    
+    Yields
+    ------
+    member_idx : int
+        index of the ensemble member
+    glac_idx : slice
+        glaciers of the chunk
+    gcm_temp_biasadj, gcm_prec_biasadj : np.array
+        bias-adjusted temperature and precipitation of the chunk
+    gcm_elev_biasadj : np.array
+        new gcm elevation of the glaciers of the chunk is the elevation of the reference climate dataset
+    """
+    nmembers, nglac = gcm_temp.shape[0], gcm_temp.shape[1]
+    ref_elev = np.broadcast_to(np.atleast_1d(ref_elev), (nglac,))
+    if glac_chunk_size is None or temp_biasadj_fxn is temp_biasadj_QDM or prec_biasadj_fxn is prec_biasadj_QDM:
+        glac_chunk_size = nglac
+    if max_workers is None:
+        max_workers = os.cpu_count()
+    
+    # Copy the climate data to shared memory
+    shms = []
+    shm_specs = {}
+    try:
+        for vn, data in [('ref_temp', ref_temp), ('ref_prec', ref_prec), ('gcm_temp', gcm_temp), 
+                         ('gcm_prec', gcm_prec)]:
+            data = np.asarray(data)
+            shm = shared_memory.SharedMemory(create=True, size=max(data.nbytes, 1))
+            shms.append(shm)
+            np.ndarray(data.shape, dtype=data.dtype, buffer=shm.buf)[...] = data
+            shm_specs[vn] = (shm.name, data.shape, data.dtype)
+        
+        tasks = ((member_idx, glac_start, min(glac_start + glac_chunk_size, nglac)) 
+                 for member_idx in range(nmembers) for glac_start in range(0, nglac, glac_chunk_size))
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_biasadj_worker_init, 
+                                 initargs=(shm_specs, dates_table_ref, dates_table)) as executor:
+            futures = set()
+            while True:
+                # bounded number of chunks in progress
+                for task in itertools.islice(tasks, 2 * max_workers - len(futures)):
+                    futures.add(executor.submit(_biasadj_chunk, *task, temp_biasadj_fxn, prec_biasadj_fxn, 
+                                                ref_elev[task[1]:task[2]], ref_spinupyears, gcm_spinupyears))
+                if not futures:
+                    break
+                done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    member_idx, glac_start, glac_end, gcm_temp_biasadj, gcm_prec_biasadj, gcm_elev_biasadj = (
+                            future.result())
+                    yield member_idx, slice(glac_start, glac_end), gcm_temp_biasadj, gcm_prec_biasadj, gcm_elev_biasadj
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
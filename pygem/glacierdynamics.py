@@ -36,6 +36,7 @@ class MassRedistributionCurveModel(FlowlineModel):
                  debug=True,
                  option_areaconstant=False, spinupyears=0, 
                  constantarea_years=0,
+                 validate=False,
                  **kwargs):
         """ Instanciate the model.
         
@@ -61,6 +62,9 @@ class MassRedistributionCurveModel(FlowlineModel):
         check_for_boundaries: bool, default: True
             raise an error when the glacier grows bigger than the domain
             boundaries
+        validate: bool, default: False
+            check that the heights agree with the flowline surface every
+            year (e.g., in tests)
         """
         super(MassRedistributionCurveModel, self).__init__(flowlines, mb_model=mb_model, y0=y0, inplace=inplace,
                                                            mb_elev_feedback='annual', **kwargs)
@@ -71,6 +75,7 @@ class MassRedistributionCurveModel(FlowlineModel):
         self.y0 = 0
         self.is_tidewater = is_tidewater
         self.water_level = water_level
+        self.validate = validate
 
 #        widths_t0 = flowlines[0].widths_m
 #        area_v1 = widths_t0 * flowlines[0].dx_meter
@@ -420,8 +425,7 @@ class MassRedistributionCurveModel(FlowlineModel):
                     # Annual glacier mass balance [m ice s-1]
                     glac_bin_massbalclim_annual = self.mb_model.get_annual_mb(heights, fls=self.fls, fl_id=fl_id, 
                                                                               year=year, debug=False)   
-                    sec_in_year = (self.mb_model.dates_table.loc[12*year:12*(year+1)-1,'daysinmonth'].values.sum() 
-                                   * 24 * 3600)
+                    sec_in_year = self.mb_model.seconds_in_year[self.mb_model.year_idx(year)]
                     
 #                    print(' volume change [m3]:', (glac_bin_massbalclim_annual * sec_in_year * 
 #                                                  (width_t0 * fl.dx_meter)).sum())
@@ -473,7 +477,8 @@ class MassRedistributionCurveModel(FlowlineModel):
         """
         # Flowlines and various attributes
         fl = fls[fl_id]
-        np.testing.assert_allclose(heights, fl.surface_h)
+        if self.validate:
+            np.testing.assert_allclose(heights, fl.surface_h)
         glacier_area_t0 = fl.widths_m * fl.dx_meter
         fl_widths_m = getattr(fl, 'widths_m', None)
         fl_section = getattr(fl,'section',None)
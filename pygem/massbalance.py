@@ -10,7 +10,7 @@ import numpy as np
 # Local libraries
 from oggm.core.massbalance import MassBalanceModel
 import pygem_input as pygem_prms
-from pygem.utils._funcs import annualweightedmean_array
+from pygem.pygem_modelsetup import dates_table_arrays
 
 #%%
 class PyGEMMassBalance(MassBalanceModel):
@@ -27,7 +27,8 @@ class PyGEMMassBalance(MassBalanceModel):
                  heights=None, repeat_period=False,
                  hyps_data=pygem_prms.hyps_data,
                  inversion_filter=False,
-                 ignore_debris=False
+                 ignore_debris=False,
+                 validate=False
                        ):
         """ Initialize.
 
@@ -47,11 +48,15 @@ class PyGEMMassBalance(MassBalanceModel):
             option to turn on print statements for development/debugging of refreezing code
         hindcast : Boolean
             switch to run the model in reverse or not (may be irrelevant after converting to OGGM's setup)
+        validate : Boolean
+            option to check that the heights agree with the flowline surface every year (default False), e.g. in 
+            tests
         """
         if debug:
             print('\n\nDEBUGGING MASS BALANCE FUNCTION\n\n')
         self.debug_refreeze = debug_refreeze
         self.inversion_filter = inversion_filter
+        self.validate = validate
 
         super(PyGEMMassBalance, self).__init__()
         self.valid_bounds = [-1e4, 2e4]  # in m
@@ -60,6 +65,8 @@ class PyGEMMassBalance(MassBalanceModel):
         # Glacier data
         self.modelprms = modelprms
         self.glacier_rgi_table = glacier_rgi_table
+        # RGI attributes used every year, so the annual loop does not index pandas
+        self.elev_ref_downscale = glacier_rgi_table.loc[pygem_prms.option_elev_ref_downscale]
         self.is_tidewater = gdir.is_tidewater
         
         if pygem_prms.hyps_data in ['Farinotti', 'Huss']:
@@ -151,7 +158,14 @@ class PyGEMMassBalance(MassBalanceModel):
         self.offglac_wide_snowpack = np.zeros(self.nmonths)
         self.offglac_wide_runoff = np.zeros(self.nmonths)
 
+        # Dates as numpy arrays, so the annual loop does not index pandas
+        dates_arrays = dates_table_arrays(self.dates_table)
         self.dayspermonth = self.dates_table['daysinmonth'].values
+        self.dates_months = dates_arrays['month']
+        self.seconds_in_year = dates_arrays['seconds_per_year']
+        #  weights of each month for annual means (days in month / days in year)
+        self.month_weights = (dates_arrays['daysinmonth'] / 
+                              (self.seconds_in_year / (24 * 3600))[dates_arrays['year_idx']])
         self.surfacetype_ddf = np.zeros((nbins))
 
         # Surface type DDF dictionary (manipulate this function for calibration or for each glacier)
@@ -181,6 +195,14 @@ class PyGEMMassBalance(MassBalanceModel):
         rgi_region = int(glacier_rgi_table.RGIId.split('-')[1].split('.')[0])
 
 
+    def year_idx(self, year):
+        """ Index of a model year in the annual arrays, which wraps around the period with repeat_period """
+        year = int(year)
+        if self.repeat_period:
+            year = year % (pygem_prms.gcm_endyear - pygem_prms.gcm_startyear)
+        return year
+
+
     def get_annual_mb(self, heights, year=None, fls=None, fl_id=None,
                       debug=False, option_areaconstant=False):
         """FIXED FORMAT FOR THE FLOWLINE MODEL
@@ -199,12 +221,11 @@ class PyGEMMassBalance(MassBalanceModel):
         mb : np.array
             mass balance for each bin [m ice per second]
         """
-        year = int(year)
-        if self.repeat_period:
-            year = year % (pygem_prms.gcm_endyear - pygem_prms.gcm_startyear)
+        year = self.year_idx(year)
 
         fl = fls[fl_id]
-        np.testing.assert_allclose(heights, fl.surface_h)
+        if self.validate:
+            np.testing.assert_allclose(heights, fl.surface_h)
         glacier_area_t0 = fl.widths_m * fl.dx_meter
         glacier_area_initial = self.glacier_area_initial
         fl_widths_m = getattr(fl, 'widths_m', None)
@@ -263,9 +284,9 @@ class PyGEMMassBalance(MassBalanceModel):
                     #  T_bin = T_gcm + lr_gcm * (z_ref - z_gcm) + lr_glac * (z_bin - z_ref) + tempchange               
                     self.bin_temp[:,12*year:12*(year+1)] = (self.glacier_gcm_temp[12*year:12*(year+1)] +
                          self.glacier_gcm_lrgcm[12*year:12*(year+1)] *
-                         (self.glacier_rgi_table.loc[pygem_prms.option_elev_ref_downscale] - self.glacier_gcm_elev) +
+                         (self.elev_ref_downscale - self.glacier_gcm_elev) +
                          self.glacier_gcm_lrglac[12*year:12*(year+1)] * (heights -
-                         self.glacier_rgi_table.loc[pygem_prms.option_elev_ref_downscale])[:, np.newaxis] +
+                         self.elev_ref_downscale)[:, np.newaxis] +
                                                 self.modelprms['tbias'])
 
                 # PRECIPITATION/ACCUMULATION: Downscale the precipitation (liquid and solid) to each bin
@@ -274,7 +295,7 @@ class PyGEMMassBalance(MassBalanceModel):
                     #  P_bin = P_gcm * prec_factor * (1 + prec_grad * (z_bin - z_ref))
                     bin_precsnow[:,12*year:12*(year+1)] = (self.glacier_gcm_prec[12*year:12*(year+1)] *
                             self.modelprms['kp'] * (1 + self.modelprms['precgrad'] * (heights -
-                            self.glacier_rgi_table.loc[pygem_prms.option_elev_ref_downscale]))[:,np.newaxis])
+                            self.elev_ref_downscale))[:,np.newaxis])
                 # Option to adjust prec of uppermost 25% of glacier for wind erosion and reduced moisture content
                 if pygem_prms.option_preclimit == 1:
                     # Elevation range based on all flowlines
@@ -428,7 +449,7 @@ class PyGEMMassBalance(MassBalanceModel):
                             if self.bin_melt[gidx,step] < pygem_prms.rf_meltcrit:
 
                                 if self.debug_refreeze and gidx == gidx_debug and step < 12:
-                                    print('\nMonth ' + str(self.dates_table.loc[step,'month']),
+                                    print('\nMonth ' + str(self.dates_months[step]),
                                           'Computing heat conduction')
 
                                 # Set refreeze equal to 0
@@ -462,7 +483,7 @@ class PyGEMMassBalance(MassBalanceModel):
                             else:
 
                                 if self.debug_refreeze and gidx == gidx_debug and step < 12:
-                                    print('\nMonth ' + str(self.dates_table.loc[step,'month']), 'Computing refreeze')
+                                    print('\nMonth ' + str(self.dates_months[step]), 'Computing refreeze')
 
                                 # Refreezing over firn surface
                                 if (self.surfacetype[gidx] == 2) or (self.surfacetype[gidx] == 3):
@@ -527,7 +548,7 @@ class PyGEMMassBalance(MassBalanceModel):
                             self.bin_refreeze[gidx,step] = self.refr[gidx]
 
                             if self.debug_refreeze and step < 12 and gidx == gidx_debug:
-                                print('Month ' + str(self.dates_table.loc[step,'month']),
+                                print('Month ' + str(self.dates_months[step]),
                                       'Rf_cold remaining:', np.round(self.rf_cold[gidx],2),
                                       'Snow depth:', np.round(self.bin_snowpack[glac_idx_t0[nbin],step],2),
                                       'Snow melt:', np.round(self.bin_meltsnow[glac_idx_t0[nbin],step],2),
@@ -539,8 +560,8 @@ class PyGEMMassBalance(MassBalanceModel):
                         #  R(m) = (-0.69 * Tair + 0.0096) * 1 m / 100 cm
                         # calculate annually and place potential refreeze in user defined month
                         if step%12 == 0:
-                            bin_temp_annual = annualweightedmean_array(self.bin_temp[:,12*year:12*(year+1)],
-                                                                       self.dates_table.iloc[12*year:12*(year+1),:])
+                            bin_temp_annual = (self.bin_temp[:,12*year:12*(year+1)] * 
+                                               self.month_weights[np.newaxis,12*year:12*(year+1)]).sum(axis=1)
                             bin_refreezepotential_annual = (-0.69 * bin_temp_annual + 0.0096) / 100
                             # Remove negative refreezing values
                             bin_refreezepotential_annual[bin_refreezepotential_annual < 0] = 0
@@ -550,7 +571,7 @@ class PyGEMMassBalance(MassBalanceModel):
                                 refreeze_potential = self.bin_refreezepotential[:,step]
 
                         if self.debug_refreeze:
-                            print('Year ' + str(year) + ' Month ' + str(self.dates_table.loc[step,'month']),
+                            print('Year ' + str(year) + ' Month ' + str(self.dates_months[step]),
                                   'Refreeze potential:', np.round(refreeze_potential[glac_idx_t0[0]],3),
                                   'Snow depth:', np.round(self.bin_snowpack[glac_idx_t0[0],step],2),
                                   'Snow melt:', np.round(self.bin_meltsnow[glac_idx_t0[0],step],2),
@@ -624,7 +645,7 @@ class PyGEMMassBalance(MassBalanceModel):
 ##                    print('surface type updated:', self.surfacetype[12:20])
 
         # Mass balance for each bin [m ice per second]
-        seconds_in_year = self.dayspermonth[12*year:12*(year+1)].sum() * 24 * 3600
+        seconds_in_year = self.seconds_in_year[year]
         mb = (self.glac_bin_massbalclim[:,12*year:12*(year+1)].sum(1)
               * pygem_prms.density_water / pygem_prms.density_ice / seconds_in_year)
         
@@ -1,4 +1,9 @@
 """ PYGEM-OGGGM COMPATIBILITY FUNCTIONS """
+# Built-in libraries
+import os
+import copy
+import time
+import collections
 # External libraries
 import numpy as np
 import pandas as pd
@@ -17,10 +22,191 @@ class CompatGlacDir:
     def __init__(self, rgiid):
         self.rgiid = rgiid
            
+class OGGMSession:
+    """OGGM configuration and glacier directories of a process
+
+    OGGM is initialized once per session (the run parameters are only set again if they were changed by other code)
+    and the glacier directories and their flowlines are kept in a least-recently-used cache of maxsize glaciers. 
+    The cache returns copies, since runs modify the glacier directories (e.g., climate data) and the flowlines. 
+    Whether a glacier directory is already processed is checked with the existence of its inversion flowlines file.
+    """
+    def __init__(self, prepro_border=pygem_prms.oggm_border, logging_level=pygem_prms.logging_level, 
+                 has_internet=pygem_prms.has_internet, working_dir=pygem_prms.oggm_gdir_fp, maxsize=128):
+        self.logging_level = logging_level
+        self.working_dir = working_dir
+        self.maxsize = maxsize
+        self.params = {
+            # Set multiprocessing to false; otherwise, causes daemonic error due to PyGEM's multiprocessing
+            #  - avoids having multiple multiprocessing going on at the same time
+            'use_multiprocessing': False,
+            # Avoid erroneous glaciers (e.g., Centerlines too short or other issues)
+            'continue_on_error': True,
+            'has_internet': has_internet,
+            # Set border boundary
+            'border': prepro_border,
+            # Usually we recommend to set dl_verify to True - here it is quite slow
+            # because of the huge files so we just turn it off.
+            # Switch it on for real cases!
+            'dl_verify': True,
+            'use_multiple_flowlines': False}
+        self.initialized = False
+        self.gdirs = collections.OrderedDict()
+
+    def initialize(self):
+        """Initialize OGGM and set up the default run parameters (once per session)"""
+        if not self.initialized:
+            cfg.initialize(logging_level=self.logging_level)
+            self.initialized = True
+        for key, value in self.params.items():
+            if cfg.PARAMS[key] != value:
+                cfg.PARAMS[key] = value
+        if cfg.PATHS.get('working_dir') != self.working_dir:
+            cfg.PATHS['working_dir'] = self.working_dir
+
+    def gdir_fp(self, rgi_id):
+        """Directory of a glacier (same layout as oggm.GlacierDirectory)"""
+        return os.path.join(self.working_dir, 'per_glacier', rgi_id[:8], rgi_id[:11], rgi_id)
+
+    def is_processed(self, rgi_id):
+        """Check if the glacier directory is already processed (inversion flowlines exist)"""
+        return os.path.exists(os.path.join(self.gdir_fp(rgi_id), 'inversion_flowlines.pkl'))
+
+    def cache_gdir(self, rgi_id, gdir):
+        self.gdirs[rgi_id] = {'gdir': gdir}
+        self.gdirs.move_to_end(rgi_id)
+        while len(self.gdirs) > self.maxsize:
+            self.gdirs.popitem(last=False)
+        return copy.deepcopy(gdir)
+
+    def pygem_tasks(self, tidewater=False):
+        """PyGEM tasks run on the glacier directories (the order matters!)"""
+        list_tasks = [          
+            # Consensus ice thickness
+            icethickness.consensus_gridded,
+            # Mass balance data
+            mbdata.mb_df_to_gdir]
+        
+        # Debris tasks
+        if pygem_prms.include_debris and not tidewater:
+            list_tasks.append(debris.debris_to_gdir)
+            list_tasks.append(debris.debris_binned)
+        return list_tasks
+
+    def process_gdirs(self, rgi_ids, tidewater=False):
+        """Initialize the glacier directories from the prepro level and run the PyGEM tasks
+        
+        Returns the glacier directories and the wall time (s) of each task.
+        """
+        # Start after the prepro task level
+        base_url = pygem_prms.oggm_base_url
+
+        task_times = {}
+        time_start = time.time()
+        gdirs = workflow.init_glacier_directories(rgi_ids, from_prepro_level=2, prepro_border=cfg.PARAMS['border'], 
+                                                  prepro_base_url=base_url, prepro_rgi_version='62')
+        task_times['init_glacier_directories'] = time.time() - time_start
+        
+        if tidewater:
+            for gdir in gdirs:
+                if not gdir.is_tidewater:
+                    raise ValueError(f'{gdir.rgi_id} is not tidewater!')
+
+        # Compute all the stuff
+        for task in self.pygem_tasks(tidewater=tidewater):
+            time_start = time.time()
+            workflow.execute_entity_task(task, gdirs)
+            task_times[task.__name__] = time.time() - time_start
+
+        return gdirs, task_times
+
+    def glacier_directory(self, rgi_id, reset=False, tidewater=False):
+        """GlacierDirectory of a glacier, from the cache, the working directory or processed"""
+        self.initialize()
+        if reset:
+            self.gdirs.pop(rgi_id, None)
+        elif rgi_id in self.gdirs:
+            self.gdirs.move_to_end(rgi_id)
+            return copy.deepcopy(self.gdirs[rgi_id]['gdir'])
+        elif self.is_processed(rgi_id):
+            return self.cache_gdir(rgi_id, utils.GlacierDirectory(rgi_id))
+        gdirs, _ = self.process_gdirs([rgi_id], tidewater=tidewater)
+        return self.cache_gdir(rgi_id, gdirs[0])
+
+    def prepare_glacier_directories(self, rgi_ids, reset=False, tidewater=False, mp_processes=None):
+        """Prepare the glacier directories of many glaciers at once with OGGM's multiprocessing
+
+        The glacier directories that are not yet processed (or all of them with reset) are initialized in one OGGM 
+        call and the PyGEM tasks are run on all of them with mp_processes processes (default is all cores). This 
+        should be done before a run and not from PyGEM's own worker processes, which cannot start processes.
+
+        Returns
+        -------
+        gdirs : list
+            GlacierDirectory objects, in the order of rgi_ids
+        task_log : pd.DataFrame
+            status ('SUCCESS' or the error) and time (s, columns <task>_time) of each task for each processed glacier
+            (indexed by RGIId), with the wall time of each task for all glaciers in task_log.attrs['wall_time']
+        """
+        self.initialize()
+        rgi_ids_process = [rgi_id for rgi_id in rgi_ids if reset or not self.is_processed(rgi_id)]
+        task_log = pd.DataFrame()
+        gdirs_processed = {}
+        if len(rgi_ids_process) > 0:
+            params = {'use_multiprocessing': cfg.PARAMS['use_multiprocessing'], 'mp_processes': cfg.PARAMS['mp_processes']}
+            cfg.PARAMS['use_multiprocessing'] = True
+            if mp_processes is not None:
+                cfg.PARAMS['mp_processes'] = mp_processes
+            try:
+                gdirs, task_times = self.process_gdirs(rgi_ids_process, tidewater=tidewater)
+            finally:
+                for key, value in params.items():
+                    cfg.PARAMS[key] = value
+            task_names = [task.__name__ for task in self.pygem_tasks(tidewater=tidewater)]
+            task_log = utils.compile_task_log(gdirs, task_names=task_names, path=False)
+            task_log = task_log.join(utils.compile_task_time(gdirs, task_names=task_names, path=False), 
+                                     rsuffix='_time')
+            task_log.attrs['wall_time'] = task_times
+            gdirs_processed = {gdir.rgi_id: gdir for gdir in gdirs}
+        # glacier directories (the ones already processed from the cache or the working directory)
+        gdirs = []
+        for rgi_id in rgi_ids:
+            if rgi_id in gdirs_processed:
+                gdir = self.cache_gdir(rgi_id, gdirs_processed[rgi_id])
+            elif rgi_id in self.gdirs:
+                gdir = copy.deepcopy(self.gdirs[rgi_id]['gdir'])
+            else:
+                gdir = self.cache_gdir(rgi_id, utils.GlacierDirectory(rgi_id))
+            gdirs.append(gdir)
+        return gdirs, task_log
+
+    def read_flowlines(self, gdir, filename='model_flowlines'):
+        """Flowlines of a glacier directory, read once and kept with the cached glacier directory (returns a copy)"""
+        cached = self.gdirs.get(gdir.rgi_id)
+        if cached is None or cached['gdir'].dir != gdir.dir:
+            return gdir.read_pickle(filename)
+        if filename not in cached:
+            cached[filename] = gdir.read_pickle(filename)
+        return copy.deepcopy(cached[filename])
+
+
+_oggm_sessions = {}
+
+def oggm_session(prepro_border=pygem_prms.oggm_border, logging_level=pygem_prms.logging_level, 
+                 has_internet=pygem_prms.has_internet, working_dir=pygem_prms.oggm_gdir_fp):
+    """OGGMSession of the process for the given settings (created on first use)"""
+    key = (prepro_border, logging_level, has_internet, working_dir)
+    if key not in _oggm_sessions:
+        _oggm_sessions[key] = OGGMSession(prepro_border=prepro_border, logging_level=logging_level, 
+                                          has_internet=has_internet, working_dir=working_dir)
+    return _oggm_sessions[key]
+
+           
 def single_flowline_glacier_directory(rgi_id, reset=pygem_prms.overwrite_gdirs, prepro_border=pygem_prms.oggm_border, 
                                       logging_level=pygem_prms.logging_level, has_internet=pygem_prms.has_internet, working_dir=pygem_prms.oggm_gdir_fp):
     """Prepare a GlacierDirectory for PyGEM (single flowline to start with)
 
+    OGGM is initialized once per process and the glacier directories are cached (see OGGMSession).
+
     Parameters
     ----------
     rgi_id : str
@@ -43,67 +229,9 @@ def single_flowline_glacier_directory(rgi_id, reset=pygem_prms.overwrite_gdirs,
     else:
         raise ValueError('Check RGIId is correct')
         
-    # Initialize OGGM and set up the default run parameters
-    cfg.initialize(logging_level=logging_level)
-    # Set multiprocessing to false; otherwise, causes daemonic error due to PyGEM's multiprocessing
-    #  - avoids having multiple multiprocessing going on at the same time
-    cfg.PARAMS['use_multiprocessing']  = False
-    
-    # Avoid erroneous glaciers (e.g., Centerlines too short or other issues)
-    cfg.PARAMS['continue_on_error'] = True
-    
-    # Has internet
-    cfg.PARAMS['has_internet'] = has_internet
-    
-    # Set border boundary
-    cfg.PARAMS['border'] = prepro_border
-    # Usually we recommend to set dl_verify to True - here it is quite slow
-    # because of the huge files so we just turn it off.
-    # Switch it on for real cases!
-    cfg.PARAMS['dl_verify'] = True
-    cfg.PARAMS['use_multiple_flowlines'] = False
-    # temporary directory for testing (deleted on computer restart)
-    cfg.PATHS['working_dir'] = working_dir
-
-    # Check if folder is already processed
-    if not reset:
-        try:
-            gdir = utils.GlacierDirectory(rgi_id)
-            gdir.read_pickle('inversion_flowlines')
-            # If the above works the directory is already processed, return
-            return gdir
-        except:
-            process_gdir = True
-        
-    else:
-        process_gdir = True
-    
-    if process_gdir:
-        # Start after the prepro task level
-        base_url = pygem_prms.oggm_base_url
-
-        cfg.PARAMS['has_internet'] = pygem_prms.has_internet
-        gdirs = workflow.init_glacier_directories([rgi_id], from_prepro_level=2, prepro_border=cfg.PARAMS['border'], 
-                                                  prepro_base_url=base_url, prepro_rgi_version='62')
-
-        # Compute all the stuff
-        list_tasks = [          
-            # Consensus ice thickness
-            icethickness.consensus_gridded,
-            # Mass balance data
-            mbdata.mb_df_to_gdir]
-        
-        # Debris tasks
-        if pygem_prms.include_debris:
-            list_tasks.append(debris.debris_to_gdir)
-            list_tasks.append(debris.debris_binned)
-            
-        for task in list_tasks:
-            workflow.execute_entity_task(task, gdirs)
-            
-        gdir = gdirs[0]
-    
-        return gdir
+    session = oggm_session(prepro_border=prepro_border, logging_level=logging_level, has_internet=has_internet, 
+                           working_dir=working_dir)
+    return session.glacier_directory(rgi_id, reset=reset)
         
 
 
@@ -116,6 +244,8 @@ def single_flowline_glacier_directory_with_calving(rgi_id, reset=pygem_prms.over
 
     k_calving is free variable!
 
+    OGGM is initialized once per process and the glacier directories are cached (see OGGMSession).
+
     Parameters
     ----------
     rgi_id : str
@@ -137,63 +267,48 @@ def single_flowline_glacier_directory_with_calving(rgi_id, reset=pygem_prms.over
     else:
         raise ValueError('Check RGIId is correct')
 
-    # Initialize OGGM and set up the default run parameters
-    cfg.initialize(logging_level=logging_level)
-    # Set multiprocessing to false; otherwise, causes daemonic error due to PyGEM's multiprocessing
-    #  - avoids having multiple multiprocessing going on at the same time
-    cfg.PARAMS['use_multiprocessing']  = False
-    
-    # Avoid erroneous glaciers (e.g., Centerlines too short or other issues)
-    cfg.PARAMS['continue_on_error'] = True
-    
-    # Has internet
-    cfg.PARAMS['has_internet'] = has_internet
-    
-    # Set border boundary
-    cfg.PARAMS['border'] = prepro_border
-    # Usually we recommend to set dl_verify to True - here it is quite slow
-    # because of the huge files so we just turn it off.
-    # Switch it on for real cases!
-    cfg.PARAMS['dl_verify'] = True
-    cfg.PARAMS['use_multiple_flowlines'] = False
-    # temporary directory for testing (deleted on computer restart)
-    cfg.PATHS['working_dir'] = working_dir
-    
-    # Check if folder is already processed
-    if not reset:
-        try:
-            gdir = utils.GlacierDirectory(rgi_id)
-            gdir.read_pickle('inversion_flowlines')
-            # If the above works the directory is already processed, return
-            return gdir
-        except:
-            process_gdir = True
-        
-    else:
-        process_gdir = True
-    
-    if process_gdir:
-        # Start after the prepro task level
-        base_url = pygem_prms.oggm_base_url
+    session = oggm_session(prepro_border=prepro_border, logging_level=logging_level, has_internet=has_internet, 
+                           working_dir=working_dir)
+    return session.glacier_directory(rgi_id, reset=reset, tidewater=True)
 
-        gdirs = workflow.init_glacier_directories([rgi_id], from_prepro_level=2, prepro_border=cfg.PARAMS['border'], 
-                                                  prepro_base_url=base_url, prepro_rgi_version='62')
-        
-        if not gdirs[0].is_tidewater:
-            raise ValueError(f'{rgi_id} is not tidewater!')
-            
-        # Compute all the stuff
-        list_tasks = [
-            # Consensus ice thickness
-            icethickness.consensus_gridded,
-            # Mass balance data
-            mbdata.mb_df_to_gdir]
-        
-        for task in list_tasks:
-            # The order matters!
-            workflow.execute_entity_task(task, gdirs)
-            
-        return gdirs[0]        
+
+def flowline_glacier_directories(rgi_ids, reset=pygem_prms.overwrite_gdirs, prepro_border=pygem_prms.oggm_border, 
+                                 logging_level=pygem_prms.logging_level, has_internet=pygem_prms.has_internet, 
+                                 working_dir=pygem_prms.oggm_gdir_fp, tidewater=False, mp_processes=None):
+    """Prepare the GlacierDirectories of many glaciers for PyGEM in parallel (see single_flowline_glacier_directory)
+
+    Parameters
+    ----------
+    rgi_ids : list
+        the rgi ids of the glaciers (e.g., '15.03473')
+    reset : bool
+        set to true to delete any pre-existing files
+    prepro_border : int
+        the size of the glacier map: 10, 80, 160, 240
+    tidewater : bool
+        set to true for tidewater glaciers (see single_flowline_glacier_directory_with_calving)
+    mp_processes : int
+        number of processes (default is all cores)
+
+    Returns
+    -------
+    gdirs : list
+        GlacierDirectory objects, in the order of rgi_ids
+    task_log : pd.DataFrame
+        status and time of each task for each processed glacier (see OGGMSession.prepare_glacier_directories)
+    """
+    rgi_ids_oggm = []
+    for rgi_id in rgi_ids:
+        if type(rgi_id) != str:
+            raise ValueError('We expect rgi_id to be a string')
+        if rgi_id.startswith('RGI60-') == False:
+            rgi_id = 'RGI60-' + rgi_id.split('.')[0].zfill(2) + '.' + rgi_id.split('.')[1]
+        rgi_ids_oggm.append(rgi_id)
+
+    session = oggm_session(prepro_border=prepro_border, logging_level=logging_level, has_internet=has_internet, 
+                           working_dir=working_dir)
+    return session.prepare_glacier_directories(rgi_ids_oggm, reset=reset, tidewater=tidewater, 
+                                               mp_processes=mp_processes)
 
 
 def create_empty_glacier_directory(rgi_id):
@@ -2,10 +2,13 @@
 
 # Built-in libaries
 import os
+import heapq
+from functools import lru_cache
 # External libraries
 import pandas as pd
 import numpy as np
 from datetime import datetime
+from scipy.optimize import nnls
 # Local libraries
 import pygem_input as pygem_prms
 
@@ -92,10 +95,7 @@ def datesmodelrun(startyear=pygem_prms.ref_startyear, endyear=pygem_prms.ref_end
     # Add column for water year
     # Water year for northern hemisphere using USGS definition (October 1 - September 30th),
     # e.g., water year for 2000 is from October 1, 1999 - September 30, 2000
-    dates_table['wateryear'] = dates_table['year']
-    for step in range(dates_table.shape[0]):
-        if dates_table.loc[step, 'month'] >= 10:
-            dates_table.loc[step, 'wateryear'] = dates_table.loc[step, 'year'] + 1
+    dates_table['wateryear'] = dates_table['year'] + (dates_table['month'] >= 10)
     # Add column for seasons
     # create a season dictionary to assist groupby functions
     seasondict = {}
@@ -108,10 +108,78 @@ def datesmodelrun(startyear=pygem_prms.ref_startyear, endyear=pygem_prms.ref_end
         else:
             season_list.append('winter')
             seasondict[month_list[i]] = season_list[i]
-    dates_table['season'] = dates_table['month'].apply(lambda x: seasondict[x])
+    dates_table['season'] = dates_table['month'].map(seasondict)
     return dates_table
 
 
+@lru_cache(maxsize=None)
+def _datesmodelrun_cached(startyear, endyear, spinupyears, option_wateryear, timestep, option_leapyear, 
+                          season_months, custom_monthdays):
+    """ Cached dates table; timestep, leap year, season and custom date options are only part of the cache key """
+    return datesmodelrun(startyear=startyear, endyear=endyear, spinupyears=spinupyears, 
+                         option_wateryear=option_wateryear)
+
+
+def datesmodelrun_cached(startyear=pygem_prms.ref_startyear, endyear=pygem_prms.ref_endyear, 
+                         spinupyears=pygem_prms.ref_spinupyears, option_wateryear=pygem_prms.ref_wateryear):
+    """
+    Memoized version of datesmodelrun for repeated calls with the same periods (e.g., reference and GCM periods).
+    
+    A copy of the cached table is returned, so the cached table is never modified by the caller.
+
+    Parameters
+    ----------
+    startyear : int
+        starting year
+    endyear : int
+        ending year
+    spinupyears : int
+        number of spinup years
+
+    Returns
+    -------
+    dates_table : pd.DataFrame
+        table where each row is a timestep and each column is attributes (date, year, wateryear, etc.) of that timestep
+    """
+    dates_table = _datesmodelrun_cached(
+            startyear, endyear, spinupyears, option_wateryear, pygem_prms.timestep, pygem_prms.option_leapyear, 
+            (pygem_prms.summer_month_start, pygem_prms.winter_month_start),
+            (getattr(pygem_prms, 'startmonthday', None), getattr(pygem_prms, 'endmonthday', None)))
+    return dates_table.copy()
+
+
+def dates_table_arrays(dates_table):
+    """
+    NumPy arrays of the dates table for loops that should not index the pandas DataFrame.
+
+    Parameters
+    ----------
+    dates_table : pd.DataFrame
+        table where each row is a timestep and each column is attributes (date, year, wateryear, etc.) of that timestep
+
+    Returns
+    -------
+    dates_arrays : dict
+        'year', 'month' and 'daysinmonth' of each timestep, 'year_idx' the index of the model year of each timestep 
+        (12 timesteps per year for monthly timesteps and the calendar year for daily timesteps), and 'seconds_per_year' 
+        the number of seconds of each model year
+    """
+    daysinmonth = dates_table['daysinmonth'].values.astype(float)
+    if pygem_prms.timestep == 'monthly':
+        year_idx = np.arange(dates_table.shape[0]) // 12
+        daysinstep = daysinmonth
+    else:
+        year_idx = np.unique(dates_table['year'].values, return_inverse=True)[1].reshape(-1)
+        daysinstep = np.ones(dates_table.shape[0])
+    seconds_per_year = np.bincount(year_idx, weights=daysinstep) * 24 * 3600
+    dates_arrays = {'year': dates_table['year'].values,
+                    'month': dates_table['month'].values,
+                    'daysinmonth': daysinmonth,
+                    'year_idx': year_idx,
+                    'seconds_per_year': seconds_per_year}
+    return dates_arrays
+
+
 def daysinmonth(year, month):
     """
     Return days in month based on the month and year
@@ -224,38 +292,137 @@ def import_Husstable(rgi_table, filepath, filedict, drop_col_names, indexname=py
     return glac_table_copy
 
 
+@lru_cache(maxsize=None)
+def _calibrationdata_byO1Id(cal_fullfn, cal_mtime):
+    """
+    Calibration data of a region csv file indexed by the RGIId Order 1 glacier number (first entry of each glacier).
+    
+    Cached for each file and modification time, so the csv file is only read and parsed once.
+    """
+    ds = pd.read_csv(cal_fullfn)
+    ds[pygem_prms.rgi_O1Id_colname] = ((ds[pygem_prms.cal_rgi_colname] % 1) * 10**5).round(0).astype(int)
+    ds_subset = ds[[pygem_prms.rgi_O1Id_colname, pygem_prms.massbal_colname, pygem_prms.massbal_uncertainty_colname,
+                    pygem_prms.massbal_time1, pygem_prms.massbal_time2]].values
+    ds_first = ~pd.Index(ds_subset[:,0]).duplicated(keep='first')
+    return pd.Index(ds_subset[ds_first,0]), ds_subset[ds_first,1:]
+
+
 def selectcalibrationdata(main_glac_rgi):
     """
     Select geodetic mass balance of all glaciers in the model run that have a geodetic mass balance.  The geodetic mass
     balances are stored in a csv file.
     """
-    # Import .csv file
+    # Import .csv file (cached)
     rgi_region = int(main_glac_rgi.loc[main_glac_rgi.index.values[0],'RGIId'].split('-')[1].split('.')[0])
-    ds = pd.read_csv(pygem_prms.cal_mb_filepath + pygem_prms.cal_mb_filedict[rgi_region])
-    main_glac_calmassbal = np.zeros((main_glac_rgi.shape[0],4))
-    ds[pygem_prms.rgi_O1Id_colname] = ((ds[pygem_prms.cal_rgi_colname] % 1) * 10**5).round(0).astype(int)
-    ds_subset = ds[[pygem_prms.rgi_O1Id_colname, pygem_prms.massbal_colname, pygem_prms.massbal_uncertainty_colname,
-                    pygem_prms.massbal_time1, pygem_prms.massbal_time2]].values
-    rgi_O1Id = main_glac_rgi[pygem_prms.rgi_O1Id_colname].values
-    for glac in range(rgi_O1Id.shape[0]):
-        try:
-            # Grab the mass balance based on the RGIId Order 1 glacier number
-            main_glac_calmassbal[glac,:] = ds_subset[np.where(np.in1d(ds_subset[:,0],rgi_O1Id[glac])==True)[0][0],1:]
-            #  np.in1d searches if there is a match in the first array with the second array provided and returns an
-            #   array with same length as first array and True/False values. np.where then used to identify the index
-            #   where there is a match, which is then used to select the massbalance value
-            #  Use of numpy arrays for indexing and this matching approach is much faster than looping through; however,
-            #   need the for loop because np.in1d does not order the values that match; hence, need to do it 1 at a time
-        except:
-            # If there is no mass balance data available for the glacier, then set as NaN
-            main_glac_calmassbal[glac,:] = np.empty(4)
-            main_glac_calmassbal[glac,:] = np.nan
+    cal_fullfn = pygem_prms.cal_mb_filepath + pygem_prms.cal_mb_filedict[rgi_region]
+    cal_O1Id, cal_data = _calibrationdata_byO1Id(cal_fullfn, os.path.getmtime(cal_fullfn))
+    # Join the mass balance to the glaciers based on the RGIId Order 1 glacier number
+    #  glaciers without mass balance data available are NaN
+    cal_idx = cal_O1Id.get_indexer(main_glac_rgi[pygem_prms.rgi_O1Id_colname].values)
+    main_glac_calmassbal = np.full((main_glac_rgi.shape[0],4), np.nan)
+    main_glac_calmassbal[cal_idx >= 0,:] = cal_data[cal_idx[cal_idx >= 0],:]
     main_glac_calmassbal = pd.DataFrame(main_glac_calmassbal,
                                         columns=[pygem_prms.massbal_colname, pygem_prms.massbal_uncertainty_colname,
                                                  pygem_prms.massbal_time1, pygem_prms.massbal_time2])
     return main_glac_calmassbal
 
 
+def _rgi_derived_columns(csv_regionO1, rgi_O1Id_colname=pygem_prms.rgi_O1Id_colname,
+                         rgi_glacno_float_colname=pygem_prms.rgi_glacno_float_colname):
+    """
+    Add the columns derived from the RGIId and dates of an RGI region table (vectorized string operations).
+    
+    The original row of each glacier is recorded as 'O1Index'.
+    """
+    rgi_table = csv_regionO1.reset_index().rename(columns={'index': 'O1Index'})
+    # Record the reference date
+    rgi_table['RefDate'] = rgi_table['BgnDate']
+    # if there is an end date, then roughly average the year
+    enddate_idx = rgi_table.loc[(rgi_table['EndDate'] > 0), 'EndDate'].index.values
+    rgi_table.loc[enddate_idx,'RefDate'] = (
+            np.mean((rgi_table.loc[enddate_idx,['BgnDate', 'EndDate']].values / 10**4).astype(int),
+                    axis=1).astype(int) * 10**4 + 9999)
+    # add column with the O1 glacier numbers
+    rgino_str = rgi_table['RGIId'].str.split('-', n=1, expand=True)[1]
+    rgino_split = rgino_str.str.split('.', n=1, expand=True)
+    rgi_table[rgi_O1Id_colname] = rgino_split[1].astype(int)
+    rgi_table['rgino_str'] = rgino_str
+    rgi_table[rgi_glacno_float_colname] = rgino_str.astype(float)
+    # Longitude between 0-360deg (no negative)
+    rgi_table['CenLon_360'] = rgi_table['CenLon']
+    rgi_table.loc[rgi_table['CenLon'] < 0, 'CenLon_360'] = (
+            360 + rgi_table.loc[rgi_table['CenLon'] < 0, 'CenLon_360'])
+    # Glacier number with no trailing zeros
+    rgi_table['glacno'] = rgino_split[0].astype(int).astype(str) + '.' + rgino_split[1]
+    return rgi_table
+
+
+def rgi_store_fullfn(rgi_fn, rgi_store_fp):
+    """
+    Filename of the indexed RGI store of an RGI region csv file (feather if pyarrow is available, otherwise pickle).
+    """
+    try:
+        import pyarrow
+        rgi_store_ext = '.feather'
+    except ImportError:
+        rgi_store_ext = '.pkl'
+    return os.path.join(rgi_store_fp, rgi_fn.replace('.csv', rgi_store_ext))
+
+
+def rgiregiontable(region, rgi_fp=pygem_prms.rgi_fp, rgi_store_fp=None,
+                   rgi_O1Id_colname=pygem_prms.rgi_O1Id_colname,
+                   rgi_glacno_float_colname=pygem_prms.rgi_glacno_float_colname):
+    """
+    RGI table of an order 1 region, including the columns derived from the RGIId and dates.
+    
+    If rgi_store_fp is specified, the csv file is converted once into a columnar store with the derived columns 
+    (feather if pyarrow is available, otherwise pickle), which is read instead of the csv file in later calls. The 
+    store is recreated if the csv file is newer or the derived column names have changed.
+
+    Parameters
+    ----------
+    region : int
+        RGI order 1 region
+    rgi_fp : str
+        filepath of the RGI csv files
+    rgi_store_fp : str
+        filepath of the indexed RGI store (default None reads the csv file)
+
+    Returns
+    -------
+    rgi_table : pd.DataFrame
+        table of all glaciers in the region
+    """
+    for i in os.listdir(rgi_fp):
+        if i.startswith(str(region).zfill(2)) and i.endswith('.csv'):
+            rgi_fn = i
+    
+    if rgi_store_fp is not None:
+        rgi_store_fn = rgi_store_fullfn(rgi_fn, rgi_store_fp)
+        if os.path.exists(rgi_store_fn) and os.path.getmtime(rgi_store_fn) >= os.path.getmtime(rgi_fp + rgi_fn):
+            if rgi_store_fn.endswith('.feather'):
+                rgi_table = pd.read_feather(rgi_store_fn)
+            else:
+                rgi_table = pd.read_pickle(rgi_store_fn)
+            if rgi_O1Id_colname in rgi_table.columns and rgi_glacno_float_colname in rgi_table.columns:
+                return rgi_table
+    
+    try:
+        csv_regionO1 = pd.read_csv(rgi_fp + rgi_fn)
+    except:
+        csv_regionO1 = pd.read_csv(rgi_fp + rgi_fn, encoding='latin1')
+    rgi_table = _rgi_derived_columns(csv_regionO1, rgi_O1Id_colname=rgi_O1Id_colname, 
+                                     rgi_glacno_float_colname=rgi_glacno_float_colname)
+    
+    if rgi_store_fp is not None:
+        os.makedirs(rgi_store_fp, exist_ok=True)
+        if rgi_store_fn.endswith('.feather'):
+            rgi_table.to_feather(rgi_store_fn)
+        else:
+            rgi_table.to_pickle(rgi_store_fn)
+    return rgi_table
+
+
 def selectglaciersrgitable(glac_no=None, rgi_regionsO1=None, rgi_regionsO2='all', rgi_glac_number='all',
                            rgi_fp=pygem_prms.rgi_fp, 
                            rgi_cols_drop=pygem_prms.rgi_cols_drop,
@@ -265,6 +432,7 @@ def selectglaciersrgitable(glac_no=None, rgi_regionsO1=None, rgi_regionsO2='all'
                            include_landterm=True,include_laketerm=True,include_tidewater=True,
                            glac_no_skip=pygem_prms.glac_no_skip,
                            min_glac_area_km2=0,
+                           rgi_store_fp=None,
                            debug=False):
     """
     Select all glaciers to be used in the model run according to the regions and glacier numbers defined by the RGI
@@ -278,6 +446,8 @@ def selectglaciersrgitable(glac_no=None, rgi_regionsO1=None, rgi_regionsO2='all'
         list of integers of RGI order 2 regions or simply 'all' for all the order 2 regions
     rgi_glac_number : list of strings
         list of RGI glacier numbers without the region (e.g., ['00001', '00002'])
+    rgi_store_fp : str
+        filepath of the indexed RGI store (see rgiregiontable); default None reads the RGI csv files
 
     Output: Pandas DataFrame of the glacier statistics for each glacier in the model run
     (rows = GlacNo, columns = glacier statistics)
@@ -296,42 +466,29 @@ def selectglaciersrgitable(glac_no=None, rgi_regionsO1=None, rgi_regionsO2='all'
         for region in rgi_regionsO1:
             glac_no_byregion[region] = sorted(glac_no_byregion[region])
 
-    # Create an empty dataframe
+    # Select the glaciers of each region
     rgi_regionsO1 = sorted(rgi_regionsO1)
-    glacier_table = pd.DataFrame()
+    glacier_tables = []
     for region in rgi_regionsO1:
 
         if glac_no is not None:
             rgi_glac_number = glac_no_byregion[region]
 
-#        if len(rgi_glac_number) < 50:
-
-        for i in os.listdir(rgi_fp):
-            if i.startswith(str(region).zfill(2)) and i.endswith('.csv'):
-                rgi_fn = i
-        try:
-            csv_regionO1 = pd.read_csv(rgi_fp + rgi_fn)
-        except:
-            csv_regionO1 = pd.read_csv(rgi_fp + rgi_fn, encoding='latin1')
+        rgi_table = rgiregiontable(region, rgi_fp=rgi_fp, rgi_store_fp=rgi_store_fp, 
+                                   rgi_O1Id_colname=rgi_O1Id_colname, 
+                                   rgi_glacno_float_colname=rgi_glacno_float_colname)
         
         # Populate glacer_table with the glaciers of interest
         if rgi_regionsO2 == 'all' and rgi_glac_number == 'all':
             if debug:
                 print("All glaciers within region(s) %s are included in this model run." % (region))
-            if glacier_table.empty:
-                glacier_table = csv_regionO1
-            else:
-                glacier_table = pd.concat([glacier_table, csv_regionO1], axis=0)
+            glacier_tables.append(rgi_table)
         elif rgi_regionsO2 != 'all' and rgi_glac_number == 'all':
             if debug:
                 print("All glaciers within subregion(s) %s in region %s are included in this model run." %
                     (rgi_regionsO2, region))
             for regionO2 in rgi_regionsO2:
-                if glacier_table.empty:
-                    glacier_table = csv_regionO1.loc[csv_regionO1['O2Region'] == regionO2]
-                else:
-                    glacier_table = (pd.concat([glacier_table, csv_regionO1.loc[csv_regionO1['O2Region'] ==
-                                                                                regionO2]], axis=0))
+                glacier_tables.append(rgi_table.loc[rgi_table['O2Region'] == regionO2])
         else:
             if len(rgi_glac_number) < 20:
                 print("%s glaciers in region %s are included in this model run: %s" % (len(rgi_glac_number), region,
@@ -341,47 +498,15 @@ def selectglaciersrgitable(glac_no=None, rgi_regionsO1=None, rgi_regionsO2='all'
                       (len(rgi_glac_number), region, rgi_glac_number[0:50]))
                 
             rgiid_subset = ['RGI60-' + str(region).zfill(2) + '.' + x for x in rgi_glac_number] 
-            rgiid_all = list(csv_regionO1.RGIId.values)
-            rgi_idx = [rgiid_all.index(x) for x in rgiid_subset if x in rgiid_all]
-            if glacier_table.empty:
-                glacier_table = csv_regionO1.loc[rgi_idx]
-            else:
-                glacier_table = (pd.concat([glacier_table, csv_regionO1.loc[rgi_idx]],
-                                           axis=0))
-                    
-    glacier_table = glacier_table.copy()
-    # reset the index so that it is in sequential order (0, 1, 2, etc.)
-    glacier_table.reset_index(inplace=True)
+            # hash-based lookup of the glaciers in the region
+            rgi_idx = pd.Index(rgi_table['RGIId']).get_indexer(rgiid_subset)
+            glacier_tables.append(rgi_table.iloc[rgi_idx[rgi_idx >= 0]])
+    
+    glacier_table = pd.concat(glacier_tables, axis=0) if len(glacier_tables) > 0 else pd.DataFrame()
     # drop connectivity 2 for Greenland and Antarctica
     glacier_table = glacier_table.loc[glacier_table['Connect'].isin([0,1])]
-    glacier_table.reset_index(drop=True, inplace=True)
-    # change old index to 'O1Index' to be easier to recall what it is
-    glacier_table.rename(columns={'index': 'O1Index'}, inplace=True)
-    # Record the reference date
-    glacier_table['RefDate'] = glacier_table['BgnDate']
-    # if there is an end date, then roughly average the year
-    enddate_idx = glacier_table.loc[(glacier_table['EndDate'] > 0), 'EndDate'].index.values
-    glacier_table.loc[enddate_idx,'RefDate'] = (
-            np.mean((glacier_table.loc[enddate_idx,['BgnDate', 'EndDate']].values / 10**4).astype(int),
-                    axis=1).astype(int) * 10**4 + 9999)
     # drop columns of data that is not being used
-    glacier_table.drop(rgi_cols_drop, axis=1, inplace=True)
-    # add column with the O1 glacier numbers
-    glacier_table[rgi_O1Id_colname] = (
-            glacier_table['RGIId'].str.split('.').apply(pd.Series).loc[:,1].astype(int))
-    glacier_table['rgino_str'] = [x.split('-')[1] for x in glacier_table.RGIId.values]
-#    glacier_table[rgi_glacno_float_colname] = (np.array([np.str.split(glacier_table['RGIId'][x],'-')[1]
-#                                                    for x in range(glacier_table.shape[0])]).astype(float))
-    glacier_table[rgi_glacno_float_colname] = (np.array([x.split('-')[1] for x in glacier_table['RGIId']]
-#            [np.str.split(glacier_table['RGIId'][x],'-')[1]
-#                                                    for x in range(glacier_table.shape[0])]
-            ).astype(float))
-    # set index name
-    glacier_table.index.name = indexname
-    # Longitude between 0-360deg (no negative)
-    glacier_table['CenLon_360'] = glacier_table['CenLon']
-    glacier_table.loc[glacier_table['CenLon'] < 0, 'CenLon_360'] = (
-            360 + glacier_table.loc[glacier_table['CenLon'] < 0, 'CenLon_360'])
+    glacier_table = glacier_table.drop(rgi_cols_drop, axis=1)
     # Subset glaciers based on their terminus type
     termtype_values = []
     if include_landterm:
@@ -397,22 +522,16 @@ def selectglaciersrgitable(glac_no=None, rgi_regionsO1=None, rgi_regionsO2='all'
     if include_laketerm:
         termtype_values.append(2)
     glacier_table = glacier_table.loc[glacier_table['TermType'].isin(termtype_values)]
-    glacier_table.reset_index(inplace=True, drop=True)
-    # Glacier number with no trailing zeros
-    glacier_table['glacno'] = [str(int(x.split('-')[1].split('.')[0])) + '.' + x.split('-')[1].split('.')[1]
-                               for x in glacier_table.RGIId]
     
     # Remove glaciers below threshold
     glacier_table = glacier_table.loc[glacier_table['Area'] > min_glac_area_km2,:]
-    glacier_table.reset_index(inplace=True, drop=True)
 
     # Remove glaciers that are meant to be skipped
     if glac_no_skip is not None:
-        glac_no_all = list(glacier_table['glacno'])
-        glac_no_unique = [x for x in glac_no_all if x not in glac_no_skip]
-        unique_idx = [glac_no_all.index(x) for x in glac_no_unique]
-        glacier_table = glacier_table.loc[unique_idx,:]
-        glacier_table.reset_index(inplace=True, drop=True)
+        glacier_table = glacier_table.loc[~glacier_table['glacno'].isin(glac_no_skip)]
+    
+    # reset the index so that it is in sequential order (0, 1, 2, etc.)
+    glacier_table = glacier_table.reset_index(drop=True)
 
     print("This study is focusing on %s glaciers in region %s" % (glacier_table.shape[0], rgi_regionsO1))
 
@@ -421,7 +540,9 @@ def selectglaciersrgitable(glac_no=None, rgi_regionsO1=None, rgi_regionsO2='all'
     # OPTION 2: CUSTOMIZE REGIONS USING A SHAPEFILE that specifies the
     #           various regions according to the RGI IDs, i.e., add an
     #           additional column to the RGI table.
-    # [INSERT CODE FOR IMPORTING A SHAPEFILE]
+    #   Glaciers in a bounding box, polygon (e.g., from a shapefile), or precomputed watersheds can be selected using
+    #   the spatial index in pygem.utils._funcs_selectglaciers (glac_frombbox, glac_frompolygon, glac_fromwatershed),
+    #   which return the glacier table of selectglaciersrgitable
     #   (1) import shapefile with custom boundaries, (2) grab the RGIIDs
     #   of glaciers that are in these boundaries, (3) perform calibration
     #   using these alternative boundaries that may (or may not) be more
@@ -509,4 +630,128 @@ def split_list(lst, n=1, option_ordered=1, group_thousands=False):
 
         lst_batches = lst_batches_th
 
+    return lst_batches
+
+
+def _glacier_cost_features(main_glac_rgi):
+    """ Features of the glacier runtime cost model: constant, area, elevation range, tidewater, tidewater * range """
+    elev_range = (main_glac_rgi['Zmax'] - main_glac_rgi['Zmin']).values.astype(float)
+    # shelf-terminating glaciers are assumed to be tidewater (see selectglaciersrgitable)
+    tidewater = main_glac_rgi['TermType'].isin([1,5]).values.astype(float)
+    return np.column_stack([np.ones(main_glac_rgi.shape[0]), main_glac_rgi['Area'].values.astype(float), 
+                            elev_range, tidewater, tidewater * elev_range])
+
+
+def glacier_cost(main_glac_rgi, timings_fullfns=None):
+    """
+    Predicted relative runtime of each glacier based on its RGI attributes and recorded timings of previous runs.
+    
+    The cost increases with the area, the elevation range (Zmax - Zmin, a proxy for the number of elevation bins) and 
+    is higher for tidewater glaciers. Without timings, the default cost is (1 + 0.1 * elevation range) for land- and 
+    lake-terminating glaciers and twice that for tidewater glaciers. With timings, the costs are converted to seconds,
+    either by fitting the non-negative coefficients to the recorded runtimes (at least 5 glaciers with timings) or 
+    otherwise by scaling the default costs with the median ratio of the runtimes to the default costs of the timed 
+    glaciers, and glaciers with a recorded runtime use their mean recorded runtime.
+
+    Parameters
+    ----------
+    main_glac_rgi : pd.DataFrame
+        table of glaciers (see selectglaciersrgitable)
+    timings_fullfns : list of str
+        csv files of recorded runtimes with columns 'glacno' and 'runtime' (see record_glacier_timing)
+
+    Returns
+    -------
+    glac_cost : np.array
+        relative cost of each glacier
+    """
+    features = _glacier_cost_features(main_glac_rgi)
+    cost_coefs = np.array([1, 0, 0.1, 1, 0.1])
+    glac_cost = features @ cost_coefs
+    
+    if timings_fullfns is not None and len(timings_fullfns) > 0:
+        timings = pd.concat([pd.read_csv(fn, dtype={'glacno':str}) for fn in timings_fullfns], axis=0)
+        timings = timings.groupby('glacno')['runtime'].mean()
+        timings_idx = timings.index.get_indexer(main_glac_rgi['glacno'].values)
+        timed = timings_idx >= 0
+        runtimes = timings.values[timings_idx[timed]]
+        fitted = False
+        if timed.sum() >= features.shape[1]:
+            cost_coefs, _ = nnls(features[timed], runtimes)
+            if cost_coefs.sum() > 0:
+                glac_cost = features @ cost_coefs
+                fitted = True
+        if timed.any() and not fitted:
+            # default costs in seconds
+            runtime_ratio = runtimes / glac_cost[timed]
+            runtime_ratio = runtime_ratio[runtime_ratio > 0]
+            if len(runtime_ratio) > 0:
+                glac_cost = glac_cost * np.median(runtime_ratio)
+        glac_cost[timed] = runtimes
+    
+    # ensure every glacier has a cost
+    glac_cost = np.maximum(glac_cost, 1e-3 * max(glac_cost.max(), 1e-3))
+    return glac_cost
+
+
+def record_glacier_timing(timings_fullfn, glacno, runtime):
+    """
+    Append the runtime [s] of a glacier to a csv file used by glacier_cost.
+    
+    Use one file per batch, so batches running simultaneously do not write to the same file.
+    """
+    write_header = not os.path.exists(timings_fullfn)
+    with open(timings_fullfn, 'a') as f:
+        if write_header:
+            f.write('glacno,runtime\n')
+        f.write(str(glacno) + ',' + str(runtime) + '\n')
+
+
+def split_list_balanced(lst, glac_cost, n=1, group_thousands=False):
+    """
+    Split list into batches of similar total cost for the supercomputer.
+    
+    Glaciers are assigned using longest-processing-time-first: the most costly glaciers are assigned first, each to the 
+    batch with the lowest total cost.
+    
+    Parameters
+    ----------
+    lst : list
+        List of glaciers (e.g., ['1.00001', '1.00002']) that you want to split into separate batches
+    glac_cost : np.array
+        cost of each glacier in the list (see glacier_cost)
+    n : int
+        Number of batches to split glaciers into.
+    group_thousands : bool
+        keep each set of thousand glaciers (e.g., '1.01' for 1.01000-1.01999) in the same batch, so two batches do not 
+        download the same set of glacier directories from oggm at the same time
+    
+    Returns
+    -------
+    lst_batches : list
+        list of n lists of glaciers in the same order as lst
+    """
+    glac_cost = np.asarray(glac_cost, dtype=float)
+    # Units assigned to batches: each glacier or each set of thousand glaciers
+    if group_thousands:
+        unit_keys = [x[:-3] for x in lst]
+    else:
+        unit_keys = list(range(len(lst)))
+    unit_keys_unique, unit_idx = np.unique(np.array(unit_keys), return_inverse=True)
+    unit_idx = unit_idx.reshape(-1)
+    unit_cost = np.bincount(unit_idx, weights=glac_cost, minlength=len(unit_keys_unique))
+    
+    if n > len(unit_keys_unique):
+        n = len(unit_keys_unique)
+    
+    # Longest-processing-time-first using a heap of the batch costs
+    batch_heap = [(0., nbatch) for nbatch in range(n)]
+    unit_batch = np.zeros(len(unit_keys_unique), dtype=int)
+    for unit in np.argsort(-unit_cost, kind='stable'):
+        batch_cost, nbatch = heapq.heappop(batch_heap)
+        unit_batch[unit] = nbatch
+        heapq.heappush(batch_heap, (batch_cost + unit_cost[unit], nbatch))
+    
+    glac_batch = unit_batch[unit_idx]
+    lst_batches = [[x for x, nbatch in zip(lst, glac_batch) if nbatch == batch] for batch in range(n)]
     return lst_batches
\ No newline at end of file
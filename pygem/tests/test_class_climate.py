@@ -0,0 +1,67 @@
+from pygem import class_climate
+from pygem import pygem_modelsetup as modelsetup
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+
+def write_cmip6(fp, name, rng, dates):
+    lat = np.arange(-89., 90., 2.)
+    lon = np.arange(0., 360., 2.5)
+    (fp / name).mkdir(parents=True, exist_ok=True)
+    tas = rng.normal(270, 10, size=(len(dates), len(lat), len(lon)))
+    xr.Dataset({'tas': (('time', 'lat', 'lon'), tas, {'units': 'K'})},
+               coords={'time': dates, 'lat': lat, 'lon': lon}).to_netcdf(fp / name / (name + '_ssp245_r1i1p1f1_tas.nc'))
+    orog = rng.uniform(0, 6000, size=(len(lat), len(lon)))
+    xr.Dataset({'orog': (('lat', 'lon'), orog, {'units': 'm'})},
+               coords={'lat': lat, 'lon': lon}).to_netcdf(fp / name / (name + '_orog.nc'))
+    return lat, lon, tas, orog
+
+
+def test_gcm_ensemble(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(class_climate.pygem_prms, 'cmip6_fp_prefix', str(tmp_path) + '/')
+    rng = np.random.default_rng(0)
+    dates_table = modelsetup.datesmodelrun(startyear=2000, endyear=2004, spinupyears=0, option_wateryear='calendar')
+    dates = pd.date_range('1999-01-01', '2005-12-01', freq='MS')
+    names = ['GCM-A', 'GCM-B', 'GCM-C']
+    grids = {name: write_cmip6(tmp_path, name, rng, dates) for name in names}
+    main_glac_rgi = pd.DataFrame({'CenLat': rng.uniform(27, 45, size=20), 'CenLon_360': rng.uniform(70, 100, size=20)})
+
+    ens = class_climate.GCMEnsemble(names=names, scenario='ssp245')
+    elev = ens.importGCMfxnearestneighbor_xarray('elev', main_glac_rgi)
+    for max_workers in [1, 3]:
+        temp, _ = ens.importGCMvarnearestneighbor_xarray('temp', main_glac_rgi, dates_table, max_workers=max_workers)
+        # Nearest neighbors of the full grid
+        for nmember, name in enumerate(names):
+            lat, lon, tas, orog = grids[name]
+            lat_idx = np.abs(main_glac_rgi['CenLat'].values[:,np.newaxis] - lat).argmin(axis=1)
+            lon_idx = np.abs(main_glac_rgi['CenLon_360'].values[:,np.newaxis] - lon).argmin(axis=1)
+            time_idx = np.flatnonzero((dates.year >= 2000) & (dates.year <= 2004))
+            np.testing.assert_allclose(temp[nmember], tas[time_idx][:, lat_idx, lon_idx].T - 273.15)
+            np.testing.assert_allclose(elev[nmember], orog[lat_idx, lon_idx])
+    # Members on the same grid share the nearest neighbors
+    assert len(ens.nn_cache) == 1
+
+
+def test_read_cells_window():
+
+    rng = np.random.default_rng(1)
+    lat = np.arange(-89., 90., 2.)
+    lon = np.arange(0., 360., 2.5)
+    data = xr.Dataset({'tas': (('time', 'lat', 'lon'), rng.random((12, len(lat), len(lon))))},
+                      coords={'time': np.arange(12), 'lat': lat, 'lon': lon})
+    main_glac_rgi = pd.DataFrame({'CenLat': rng.uniform(-60, 70, size=50), 'CenLon_360': rng.uniform(0, 360, size=50)})
+    gcm = class_climate.GCM(name='GCM-A', scenario='ssp245')
+
+    # Nearest neighbors of the window are those of the full grid
+    window = gcm._latlon_window(data, main_glac_rgi)
+    lat_idx, lon_idx = gcm._nearest_latlon_idx(data, main_glac_rgi)
+    lat_idx_window, lon_idx_window = gcm._nearest_latlon_idx(data.isel(window), main_glac_rgi)
+    np.testing.assert_array_equal(lat_idx_window + window['lat'].start, lat_idx)
+    np.testing.assert_array_equal(lon_idx_window + window.get('lon', slice(0, None)).start, lon_idx)
+
+    # Reading chunks of a few latitude rows gives the cell time series
+    for chunk_nbytes in [1, 2**12, 2**28]:
+        cell_series = gcm._read_cells(data['tas'], lat_idx, lon_idx, chunk_nbytes=chunk_nbytes)
+        np.testing.assert_array_equal(cell_series, data['tas'].values[:, lat_idx, lon_idx].T)
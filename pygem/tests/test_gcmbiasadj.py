@@ -0,0 +1,68 @@
+from pygem import gcmbiasadj
+import numpy as np
+from scipy.stats import percentileofscore
+
+
+def test_percentileofscore_2darray():
+
+    rng = np.random.default_rng(0)
+    x = np.round(rng.normal(size=(3, 240)), 1)
+    pct = gcmbiasadj.percentileofscore_2darray(x)
+
+    # Check against scipy for every value, including ties
+    for row in range(x.shape[0]):
+        pct_scipy = [percentileofscore(x[row], value) for value in x[row]]
+        np.testing.assert_allclose(pct[row], pct_scipy)
+
+
+def test_qdm_adjust():
+
+    rng = np.random.default_rng(1)
+    ref = rng.normal(270, 5, size=(2, 240))
+    gcm = rng.normal(272, 6, size=(2, 240))
+    bc = rng.normal(274, 6, size=(2, 1212))
+    loop_months = 240
+    bc_adj = gcmbiasadj.qdm_adjust(bc, ref, gcm, loop_months)
+
+    # Check against the percentile of each value in its period
+    for glac in range(bc.shape[0]):
+        for nperiod in range(int(np.ceil(bc.shape[1] / loop_months))):
+            bc_period = bc[glac, nperiod*loop_months:(nperiod+1)*loop_months]
+            for nvalue, value in enumerate(bc_period[::37]):
+                percentile = percentileofscore(bc_period, value)
+                value_adj = value * np.percentile(ref, percentile) / np.percentile(gcm, percentile)
+                np.testing.assert_allclose(bc_adj[glac, nperiod*loop_months + nvalue*37], value_adj)
+
+
+def test_biasadj_ensemble():
+
+    from pygem import pygem_modelsetup as modelsetup
+    rng = np.random.default_rng(2)
+    dates_table_ref = modelsetup.datesmodelrun(startyear=2000, endyear=2019, spinupyears=0, option_wateryear='calendar')
+    dates_table = modelsetup.datesmodelrun(startyear=2000, endyear=2040, spinupyears=0, option_wateryear='calendar')
+    nmembers, nglac = 2, 7
+    ref_temp = rng.normal(0, 5, size=(nglac, len(dates_table_ref)))
+    ref_prec = rng.gamma(2, 0.05, size=(nglac, len(dates_table_ref)))
+    ref_elev = rng.uniform(1000, 5000, size=nglac)
+    gcm_temp = rng.normal(1, 6, size=(nmembers, nglac, len(dates_table)))
+    gcm_prec = rng.gamma(2, 0.06, size=(nmembers, nglac, len(dates_table)))
+
+    for temp_fxn, prec_fxn in [(gcmbiasadj.temp_biasadj_HH2015, gcmbiasadj.prec_biasadj_opt1),
+                               (gcmbiasadj.temp_biasadj_QDM, gcmbiasadj.prec_biasadj_QDM)]:
+        temp = np.full(gcm_temp.shape, np.nan)
+        prec = np.full(gcm_prec.shape, np.nan)
+        elev = np.full((nmembers, nglac), np.nan)
+        for member_idx, glac_idx, temp_chunk, prec_chunk, elev_chunk in gcmbiasadj.biasadj_ensemble(
+                ref_temp, ref_prec, ref_elev, gcm_temp, gcm_prec, dates_table_ref, dates_table,
+                temp_biasadj_fxn=temp_fxn, prec_biasadj_fxn=prec_fxn, glac_chunk_size=3, max_workers=2):
+            temp[member_idx, glac_idx] = temp_chunk
+            prec[member_idx, glac_idx] = prec_chunk
+            elev[member_idx, glac_idx] = elev_chunk
+
+        # Same as the serial bias adjustment of each member
+        for member_idx in range(nmembers):
+            temp_serial, _ = temp_fxn(ref_temp, ref_elev, gcm_temp[member_idx], dates_table_ref, dates_table)
+            prec_serial, _ = prec_fxn(ref_prec, ref_elev, gcm_prec[member_idx], dates_table_ref, dates_table)
+            np.testing.assert_allclose(temp[member_idx], temp_serial)
+            np.testing.assert_allclose(prec[member_idx], prec_serial)
+            np.testing.assert_array_equal(elev[member_idx], ref_elev)
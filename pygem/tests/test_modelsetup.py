@@ -0,0 +1,166 @@
+from pygem import pygem_modelsetup as modelsetup
+import numpy as np
+import pandas as pd
+import os
+
+
+def test_split_list_balanced():
+
+    rng = np.random.default_rng(0)
+    glacno = ['1.' + str(i).zfill(5) for i in range(1, 5001)]
+    glac_cost = rng.lognormal(0, 1, size=len(glacno))
+    n = 7
+
+    # Batch costs within the largest glacier cost of the mean batch cost
+    batches = modelsetup.split_list_balanced(glacno, glac_cost, n=n)
+    cost_dict = dict(zip(glacno, glac_cost))
+    batch_costs = np.array([sum(cost_dict[x] for x in batch) for batch in batches])
+    assert sorted(x for batch in batches for x in batch) == glacno
+    assert batch_costs.max() - batch_costs.mean() <= glac_cost.max()
+
+    # Sets of thousand glaciers are never split
+    batches = modelsetup.split_list_balanced(glacno, glac_cost, n=3, group_thousands=True)
+    assert sorted(x for batch in batches for x in batch) == glacno
+    thousands_batch = {}
+    for nbatch, batch in enumerate(batches):
+        for x in batch:
+            assert thousands_batch.setdefault(x[:-3], nbatch) == nbatch
+
+
+def test_glacier_cost_timings(tmp_path):
+
+    main_glac_rgi = pd.DataFrame({'glacno': ['1.00001', '1.00002', '1.00003', '1.00004'],
+                                  'Area': [1., 2., 3., 4.], 'Zmin': [1000, 1000, 1000, 1000],
+                                  'Zmax': [1990, 1990, 2990, 2990], 'TermType': [0, 0, 0, 0]})
+    # Too few timings to fit the cost model: default costs (100, 100, 200, 200) scaled to seconds
+    timings_fullfn = str(tmp_path / 'timings.csv')
+    modelsetup.record_glacier_timing(timings_fullfn, '1.00001', 600.)
+    glac_cost = modelsetup.glacier_cost(main_glac_rgi, timings_fullfns=[timings_fullfn])
+    np.testing.assert_allclose(glac_cost, [600, 600, 1200, 1200])
+
+
+def write_rgi_csv(rgi_fp, region, nglac, rng):
+    # Synthetic RGI region csv file
+    rgi_fp.mkdir(exist_ok=True)
+    rgi_csv = pd.DataFrame({'RGIId': ['RGI60-' + str(region).zfill(2) + '.' + str(i).zfill(5) for i in range(1, nglac+1)],
+                            'GLIMSId': 'G0', 'BgnDate': 20000801, 
+                            'EndDate': np.where(rng.random(nglac) < 0.1, 20040801, -9999999),
+                            'CenLon': rng.uniform(-180, 180, size=nglac), 'CenLat': rng.uniform(-60, 80, size=nglac),
+                            'O1Region': region, 'O2Region': rng.integers(1, 4, size=nglac), 
+                            'Area': rng.lognormal(0, 1, size=nglac), 'Zmin': 3000, 'Zmax': 5000, 'Zmed': 4000, 
+                            'Slope': 20., 'Aspect': 180, 'Lmax': 1000, 'Status': 0, 
+                            'Connect': rng.choice([0, 1, 2], p=[0.8, 0.1, 0.1], size=nglac), 'Form': 0, 
+                            'TermType': rng.choice([0, 1, 2, 5, 9], size=nglac), 'Surging': 9, 'Linkages': 9, 
+                            'Name': None, 'IsMarine': 0})
+    rgi_csv.to_csv(rgi_fp / (str(region).zfill(2) + '_rgi60_Region.csv'), index=False)
+    return rgi_csv
+
+
+def test_selectglaciersrgitable_store(tmp_path):
+
+    rng = np.random.default_rng(1)
+    rgi_fp = tmp_path / 'rgi'
+    rgi_csv = write_rgi_csv(rgi_fp, 15, 2000, rng)
+    rgi_fp, rgi_store_fp = str(rgi_fp) + '/', str(tmp_path / 'rgistore') + '/'
+
+    # The store (written by the first call, then read) gives the table of the csv file
+    table_csv = modelsetup.selectglaciersrgitable(rgi_regionsO1=[15], rgi_fp=rgi_fp)
+    for _ in range(2):
+        table_store = modelsetup.selectglaciersrgitable(rgi_regionsO1=[15], rgi_fp=rgi_fp, rgi_store_fp=rgi_store_fp)
+        pd.testing.assert_frame_equal(table_store, table_csv)
+    assert (table_csv['Connect'] != 2).all() and table_csv['glacno'].iloc[0].startswith('15.')
+    assert table_csv.loc[table_csv['EndDate'] > 0, 'RefDate'].eq(20029999).all()
+
+    # Glacier lists, subregions, terminus types and skipped glaciers give the subset of the region table in RGI order
+    glac_no = list(rng.permutation(rgi_csv['RGIId'].str[6:].values)[:300])
+    glac_no = [str(int(x.split('.')[0])) + '.' + x.split('.')[1] for x in glac_no]
+    table = modelsetup.selectglaciersrgitable(glac_no=glac_no, rgi_fp=rgi_fp, rgi_store_fp=rgi_store_fp)
+    pd.testing.assert_frame_equal(table, table_csv[table_csv['glacno'].isin(glac_no)].reset_index(drop=True))
+    table = modelsetup.selectglaciersrgitable(rgi_regionsO1=[15], rgi_regionsO2=[2], rgi_fp=rgi_fp, 
+                                              include_tidewater=False, glac_no_skip=glac_no[:10],
+                                              rgi_store_fp=rgi_store_fp)
+    subset = ((table_csv['O2Region'] == 2) & ~table_csv['TermType'].isin([1, 5]) & 
+              ~table_csv['glacno'].isin(glac_no[:10]))
+    pd.testing.assert_frame_equal(table, table_csv[subset].reset_index(drop=True))
+
+    # The store is rebuilt when the csv file is newer
+    rgi_csv.loc[0, 'Area'] = 123.
+    rgi_csv.to_csv(rgi_fp + '15_rgi60_Region.csv', index=False)
+    rgi_store_fn = modelsetup.rgi_store_fullfn('15_rgi60_Region.csv', rgi_store_fp)
+    os.utime(rgi_store_fn, (0, 0))
+    assert modelsetup.rgiregiontable(15, rgi_fp=rgi_fp, rgi_store_fp=rgi_store_fp).loc[0, 'Area'] == 123.
+
+
+def test_glacier_spatialindex(tmp_path):
+
+    from pygem.utils import _funcs_selectglaciers as selectglaciers
+    import shapely
+    rng = np.random.default_rng(2)
+    rgi_csv = pd.concat([write_rgi_csv(tmp_path / 'rgi', region, 1000, rng) for region in [1, 15]], ignore_index=True)
+    rgi_fp = str(tmp_path / 'rgi') + '/'
+    watershed_fullfn = str(tmp_path / 'watershed.csv')
+    pd.DataFrame({'RGIId': rgi_csv['RGIId'][::2], 'watershed': np.arange(0, len(rgi_csv), 2) % 7}).to_csv(
+            watershed_fullfn, index=False)
+    spatialindex_fullfn = str(tmp_path / 'spatialindex.npz')
+    spatialindex = selectglaciers.glacier_spatialindex([1, 15], spatialindex_fullfn, rgi_fp=rgi_fp, 
+                                                       watershed_fullfn=watershed_fullfn, cell_size=2.)
+    kwargs = {'rgi_fp': rgi_fp, 'glac_no_skip': None}
+    table_all = modelsetup.selectglaciersrgitable(rgi_regionsO1=[1, 15], **kwargs)
+    lon, lat = table_all['CenLon'].values, table_all['CenLat'].values
+
+    # Queries give the glacier tables of the brute force selections, also across the dateline
+    for lon_min, lon_max, lat_min, lat_max in [(10, 40, 35, 50), (170, -170, -30, 70), (-180, 180, -90, 90), 
+                                               (5.5, 5.6, 40, 40.2)]:
+        in_lon = ((lon >= lon_min) | (lon <= lon_max)) if lon_min > lon_max else ((lon >= lon_min) & (lon <= lon_max))
+        in_bbox = in_lon & (lat >= lat_min) & (lat <= lat_max)
+        table = selectglaciers.glac_frombbox(spatialindex, lon_min, lon_max, lat_min, lat_max, **kwargs)
+        assert sorted(table.get('glacno', [])) == sorted(table_all['glacno'][in_bbox])
+    polygon = shapely.Polygon([(0, 30), (60, 35), (30, 60)])
+    table = selectglaciers.glac_frompolygon(spatialindex, polygon, **kwargs)
+    pd.testing.assert_frame_equal(table, table_all[shapely.contains_xy(polygon, lon, lat)].reset_index(drop=True))
+    table = selectglaciers.glac_fromwatershed(spatialindex, [3, 5], **kwargs)
+    in_watershed = table_all['RGIId'].isin(rgi_csv['RGIId'][::2][np.isin(np.arange(0, len(rgi_csv), 2) % 7, [3, 5])])
+    pd.testing.assert_frame_equal(table, table_all[in_watershed].reset_index(drop=True))
+
+    # The saved index is loaded with the same source and rebuilt when the source changes
+    spatialindex = selectglaciers.glacier_spatialindex([1, 15], spatialindex_fullfn, rgi_fp=rgi_fp, 
+                                                       watershed_fullfn=watershed_fullfn, cell_size=2.)
+    assert spatialindex.source['watershed_fullfn'] == watershed_fullfn
+    spatialindex = selectglaciers.glacier_spatialindex([15], spatialindex_fullfn, rgi_fp=rgi_fp, cell_size=2.)
+    assert len(spatialindex.glacno) == 1000 and (spatialindex.watershed == '').all()
+
+
+def test_selectcalibrationdata(tmp_path, monkeypatch):
+
+    prms = modelsetup.pygem_prms
+    for name, value in [('cal_mb_filepath', str(tmp_path) + '/'), ('cal_mb_filedict', {15: 'cal_15.csv'}), 
+                        ('cal_rgi_colname', 'RGIId'), ('rgi_O1Id_colname', 'O1Id'), ('massbal_colname', 'mb'), 
+                        ('massbal_uncertainty_colname', 'mb_err'), ('massbal_time1', 't1'), ('massbal_time2', 't2')]:
+        monkeypatch.setattr(prms, name, value)
+    rng = np.random.default_rng(3)
+    # calibration data of some glaciers, with duplicates
+    cal_O1Id = rng.choice(np.arange(1, 3000), size=2500)
+    cal = pd.DataFrame({'RGIId': 15 + cal_O1Id / 1e5, 'mb': rng.normal(size=2500), 'mb_err': rng.random(2500), 
+                        't1': 2000., 't2': 2020.})
+    cal.to_csv(tmp_path / 'cal_15.csv', index=False)
+    cal = pd.read_csv(tmp_path / 'cal_15.csv')
+    main_glac_rgi = pd.DataFrame({'RGIId': ['RGI60-15.' + str(i).zfill(5) for i in range(1, 3001)], 
+                                  'O1Id': np.arange(1, 3001)})
+
+    # Same as the loop of the first match of each glacier
+    cal_values = cal[['mb', 'mb_err', 't1', 't2']].values
+    expected = np.full((len(main_glac_rgi), 4), np.nan)
+    for glac, O1Id in enumerate(main_glac_rgi['O1Id'].values):
+        match = np.flatnonzero(cal_O1Id == O1Id)
+        if len(match) > 0:
+            expected[glac] = cal_values[match[0]]
+    calmassbal = modelsetup.selectcalibrationdata(main_glac_rgi)
+    assert list(calmassbal.columns) == ['mb', 'mb_err', 't1', 't2']
+    np.testing.assert_array_equal(calmassbal.values, expected)
+
+    # The cached data is reread when the file changes
+    cal['mb'] = 1.
+    cal.to_csv(tmp_path / 'cal_15.csv', index=False)
+    os.utime(tmp_path / 'cal_15.csv', (1e9, 1e9))
+    calmassbal = modelsetup.selectcalibrationdata(main_glac_rgi)
+    assert (calmassbal['mb'][np.isfinite(expected[:,0])] == 1).all()
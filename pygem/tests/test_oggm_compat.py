@@ -1,4 +1,5 @@
 from pygem import oggm_compat
+from pygem import pygem_modelsetup as modelsetup
 import numpy as np
 
 do_plot = False
@@ -19,6 +20,64 @@ def test_single_flowline_glacier_directory():
         plt.show()
 
 
+def test_oggm_session():
+
+    session = oggm_compat.OGGMSession(prepro_border=80)
+    rid = 'RGI60-15.03473'
+    gdir = session.glacier_directory(rid)
+    assert session.is_processed(rid)
+    # Cached glacier directory and flowlines are returned as copies
+    gdir_cached = session.glacier_directory(rid)
+    assert gdir_cached is not gdir and gdir_cached.dir == gdir.dir
+    fls = session.read_flowlines(gdir)
+    fls_cached = session.read_flowlines(gdir_cached)
+    assert fls_cached is not fls
+    np.testing.assert_array_equal(fls_cached[0].thick, fls[0].thick)
+
+
+def test_flowline_glacier_directories():
+
+    rids = ['15.03473', '15.03733']
+    gdirs, task_log = oggm_compat.flowline_glacier_directories(rids, reset=True, prepro_border=80)
+    assert [gdir.rgi_id for gdir in gdirs] == ['RGI60-15.03473', 'RGI60-15.03733']
+    assert (task_log['consensus_gridded'] == 'SUCCESS').all()
+    assert 'consensus_gridded_time' in task_log
+
+
+def run_mass_redistribution(gdir, fls, nyears=10, repeat_period=False):
+    # Run the mass balance and mass redistribution models on synthetic climate with validation on
+    from oggm import cfg
+    from pygem.massbalance import PyGEMMassBalance
+    from pygem.glacierdynamics import MassRedistributionCurveModel
+    glacier_rgi_table = modelsetup.selectglaciersrgitable(glac_no=[gdir.rgi_id.split('-')[1]]).loc[0]
+    gdir.dates_table = modelsetup.datesmodelrun(startyear=2000, endyear=2000+nyears-1, spinupyears=0, 
+                                                option_wateryear='calendar')
+    nmonths = gdir.dates_table.shape[0]
+    gdir.historical_climate = {'elev': glacier_rgi_table['Zmed'], 
+                               'temp': -2 + 8 * np.sin(2 * np.pi * (gdir.dates_table['month'].values - 4) / 12),
+                               'tempstd': np.zeros(nmonths), 'prec': np.full(nmonths, 0.1), 
+                               'lr': np.full(nmonths, -0.0065)}
+    modelprms = {'kp': 1., 'tbias': 0., 'ddfsnow': 0.0041, 'ddfice': 0.0041 / 0.7, 'tsnow_threshold': 1., 
+                 'precgrad': 0.0001}
+    mbmod = PyGEMMassBalance(gdir, modelprms, glacier_rgi_table, fls=fls, option_areaconstant=False, 
+                             repeat_period=repeat_period, validate=True)
+    ev_model = MassRedistributionCurveModel(fls, mb_model=mbmod, y0=0, glen_a=cfg.PARAMS['glen_a'], fs=0, 
+                                            is_tidewater=gdir.is_tidewater, inplace=True, validate=True)
+    ev_model.run_until(nyears)
+    return mbmod.glac_wide_volume_annual.copy()
+
+
+def test_mass_redistribution():
+
+    session = oggm_compat.OGGMSession(prepro_border=80)
+    gdir = session.glacier_directory('RGI60-15.03473')
+    volume = run_mass_redistribution(gdir, session.read_flowlines(gdir), nyears=10)
+    assert np.isfinite(volume).all() and (volume > 0).all()
+    # A second run on the cached glacier directory and flowlines starts from the same state
+    gdir = session.glacier_directory('RGI60-15.03473')
+    np.testing.assert_array_equal(run_mass_redistribution(gdir, session.read_flowlines(gdir), nyears=10), volume)
+
+
 def test_get_glacier_zwh():
 
     rid = 'RGI60-15.03473'
@@ -0,0 +1,300 @@
+from pygem import output
+from pygem import pygem_modelsetup as modelsetup
+import pytest
+import json
+import os
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+
+def test_stats_accumulator():
+
+    rng = np.random.default_rng(0)
+    stats_cns = output.stats_cns_all
+    data = rng.normal(size=(200, 300))
+    data[0, :10] = np.nan
+
+    # Exact as long as the simulations fit in the exact buffer
+    acc = output.stats_accumulator(200, stats_cns, exact_iters=300)
+    for j in range(data.shape[1]):
+        acc.add(data[:, j])
+    np.testing.assert_array_equal(acc.stats(), output.calc_stats_array(data, stats_cns))
+
+    # Streaming: exact mean and std, close median and mad
+    acc = output.stats_accumulator(200, stats_cns, exact_iters=50)
+    for j in range(data.shape[1]):
+        acc.add(data[:, j])
+    stats = acc.stats()
+    stats_exact = output.calc_stats_array(data, stats_cns)
+    for cn in ['mean', 'std']:
+        i = stats_cns.index(cn)
+        np.testing.assert_allclose(stats[:, i], stats_exact[:, i])
+    for cn in ['median', 'mad']:
+        i = stats_cns.index(cn)
+        assert np.median(np.abs(stats[:, i] - stats_exact[:, i])) < 0.05
+
+
+def test_bitround():
+
+    rng = np.random.default_rng(1)
+    values = np.exp(rng.normal(0, 10, size=1000))
+    values[0] = np.nan
+    for keepbits in [3, 10, 20]:
+        rounded = output.bitround(values, keepbits)
+        assert np.isnan(rounded[0])
+        np.testing.assert_array_less(np.abs(rounded[1:] - values[1:]), 2.**-(keepbits+1) * values[1:] * (1 + 1e-12))
+        np.testing.assert_array_equal(output.bitround(rounded, keepbits)[1:], rounded[1:])
+
+
+def test_sparse_binned_ds():
+
+    rng = np.random.default_rng(2)
+    nglac, nbins, nyears = 3, 40, 20
+    values = rng.normal(size=(nglac, nbins, nyears))
+    # retreating glaciers (zero below the terminus), zero bins within the glacier and NaN padded bins
+    terminus = np.linspace(35, 0, nyears).astype(int)
+    values = np.where(np.arange(nbins)[np.newaxis, :, np.newaxis] >= terminus[np.newaxis, np.newaxis, :], 0, values)
+    values[1, 3:6, :] = 0
+    values[2, 30:, :] = np.nan
+    ds = xr.Dataset({'bin_thick_annual': (('glac', 'bin', 'year'), values, {'units': 'm'}),
+                     'bin_distance': (('glac', 'bin'), rng.random((nglac, nbins)))},
+                    coords={'glac': np.arange(nglac), 'bin': np.arange(nbins), 'year': np.arange(nyears)})
+
+    sparse_ds, _ = output.sparse_binned_ds(ds, glac_nbins=[nbins, nbins, 30])
+    assert sparse_ds['bin_thick_annual'].size < np.isfinite(values).sum()
+    xr.testing.assert_identical(output.dense_binned_ds(sparse_ds), ds)
+
+
+def test_compiled_regional(tmp_path):
+
+    rng = np.random.default_rng(3)
+    years = np.arange(2000, 2011)
+    output_fullfns, mass, mad = [], [], []
+    for nfile, nglac in enumerate([1, 3, 2]):
+        mass.append(rng.random((nglac, len(years))) * 1e12)
+        mad.append(rng.random((nglac, len(years))) * 1e10)
+        ds = xr.Dataset({'RGIId': ('glac', ['RGI60-15.' + str(nfile*10 + i).zfill(5) for i in range(nglac)]),
+                         'glac_mass_annual': (('glac', 'year'), mass[-1]),
+                         'glac_mass_annual_mad': (('glac', 'year'), mad[-1])},
+                        coords={'glac': np.arange(nglac), 'year': years})
+        output_fullfns.append(str(tmp_path / ('stats_' + str(nfile) + '.nc')))
+        ds.to_netcdf(output_fullfns[-1])
+    mass, mad = np.concatenate(mass), np.concatenate(mad)
+
+    compiled_fullfn = output.regional_annual_mass(output_fullfns, str(tmp_path) + '/', 'reg15_mass.nc', 
+                                                  glac_chunksize=2).compile()
+    with xr.open_dataset(compiled_fullfn) as ds:
+        assert ds['RGIId'].size == 6
+        np.testing.assert_allclose(ds['glac_mass_annual'].values, mass)
+        np.testing.assert_allclose(ds['reg_glac_mass_annual'].values, mass.sum(axis=0))
+        np.testing.assert_allclose(ds['reg_glac_mass_annual_mad_correlated'].values, mad.sum(axis=0))
+        np.testing.assert_allclose(ds['reg_glac_mass_annual_mad_independent'].values, np.sqrt((mad**2).sum(axis=0)))
+
+    # total runoff is compiled as its own variable
+    time = pd.date_range('2000-01-01', periods=24, freq='MS')
+    runoff_fullfns, runoff = [], []
+    for nfile in range(2):
+        glac_runoff, offglac_runoff = rng.random((2, 3, len(time)))
+        runoff.append(glac_runoff + offglac_runoff)
+        runoff_fullfns.append(str(tmp_path / ('runoff_' + str(nfile) + '.nc')))
+        xr.Dataset({'RGIId': ('glac', ['RGI60-15.' + str(nfile*10 + i).zfill(5) for i in range(3)]),
+                    'glac_runoff_monthly': (('glac', 'time'), glac_runoff), 
+                    'offglac_runoff_monthly': (('glac', 'time'), offglac_runoff)},
+                   coords={'glac': np.arange(3), 'time': time}).to_netcdf(runoff_fullfns[-1])
+    compiled_fullfn = output.regional_monthly_runoff(runoff_fullfns, str(tmp_path) + '/', 'reg15_runoff.nc').compile()
+    with xr.open_dataset(compiled_fullfn) as ds:
+        assert 'glac_runoff_monthly' not in ds
+        np.testing.assert_allclose(ds['reg_runoff_monthly'].values, np.concatenate(runoff).sum(axis=0))
+
+    # missing variables and inconsistent time axes
+    with pytest.raises(ValueError, match='export_extra_vars'):
+        output.regional_monthly_massbal(output_fullfns, str(tmp_path) + '/', 'reg15_massbal.nc').compile()
+    xr.Dataset({'RGIId': ('glac', ['RGI60-15.00100']), 'glac_mass_annual': (('glac', 'year'), mass[:1,:-1])},
+               coords={'glac': [0], 'year': years[:-1]}).to_netcdf(tmp_path / 'stats_short.nc')
+    with pytest.raises(ValueError, match='year axis'):
+        output.regional_annual_mass(output_fullfns + [str(tmp_path / 'stats_short.nc')], str(tmp_path) + '/', 
+                                    'reg15_mass.nc').compile()
+
+
+def rgi_series(i):
+    # RGI table of a glacier of region 15
+    return pd.Series({'RGIId': 'RGI60-15.' + str(i+1).zfill(5), 'RGIId_float': 15 + (i+1) / 1e5, 'O1Region': 15, 
+                      'O2Region': 1, 'CenLon': 86., 'CenLat': 28., 'Area': 1.}, name=i)
+
+
+def test_run_metadata(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(output.pygem_prms, 'output_sim_fp', str(tmp_path) + '/')
+    monkeypatch.setattr(output.pygem_prms, 'option_calibration', None)
+    output.single_glacier.clear_run_metadata()
+    dates_table = modelsetup.datesmodelrun(startyear=2000, endyear=2004, spinupyears=0, option_wateryear='calendar')
+    glacier_outputs = [output.glacierwide_stats(rgi_series(i), dates_table, '1.0', 'CESM2', 'ssp245', None, 1, 
+                                                {'kp': 1., 'ddfsnow': 0.004, 'tbias': 0., 'precgrad': 1e-4 * i}, 2000, 2000, 2004) 
+                       for i in range(2)]
+
+    # The run parameters are serialized once and written once for the run, the glaciers only record their modelprms
+    assert glacier_outputs[0].run_params is glacier_outputs[1].run_params
+    for i, glacier_output in enumerate(glacier_outputs):
+        glacier_output.create_xr_ds()
+        attrs = glacier_output.get_xr_ds().attrs
+        assert json.loads(attrs['model_parameters']) == {'kp': 1., 'ddfsnow': 0.004, 'tbias': 0., 'precgrad': 1e-4 * i}
+        glacier_output.save_xr_ds(glacier_output.get_fn() + 'all.nc')
+    run_params_fullfn = glacier_outputs[0].outdir + attrs['run_parameters_file']
+    with open(run_params_fullfn) as f:
+        run_params = json.load(f)
+    assert run_params['gcm_name'] == 'CESM2' and run_params['ref_startyear'] == output.pygem_prms.ref_startyear
+    assert 'kp' not in run_params
+
+    # A change of pygem_prms within the process gives new run parameters
+    monkeypatch.setattr(output.pygem_prms, 'ref_startyear', 1980)
+    glacier_output = output.glacierwide_stats(rgi_series(2), dates_table, '1.0', 'CESM2', 'ssp245', None, 1, 
+                                              {'kp': 1., 'ddfsnow': 0.004, 'tbias': 0.}, 2000, 2000, 2004)
+    glacier_output.create_xr_ds()
+    glacier_output.save_xr_ds(glacier_output.get_fn() + 'all.nc')
+    with open(run_params_fullfn) as f:
+        assert json.load(f)['ref_startyear'] == 1980
+
+
+def test_create_xr_ds(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(output.pygem_prms, 'output_sim_fp', str(tmp_path) + '/')
+    dates_table = modelsetup.datesmodelrun(startyear=2000, endyear=2004, spinupyears=0, option_wateryear='calendar')
+    for sim_iters in [1, 50]:
+        for glacier_output in [
+                output.glacierwide_stats(rgi_series(0), dates_table, '1.0', 'CESM2', 'ssp245', None, sim_iters, 
+                                         {'kp': 1.}, 2000, 2000, 2004),
+                output.binned_stats(rgi_series(0), dates_table, '1.0', 'CESM2', 'ssp245', None, sim_iters, 
+                                    {'kp': 1.}, 2000, 2000, 2004, nbins=12)]:
+            glacier_output.create_xr_ds()
+            output_ds = glacier_output.get_xr_ds()
+            # Same as merging a dataset of each variable
+            ref_ds = None
+            for vn, vn_coords in glacier_output.output_coords_dict.items():
+                vn_ds = xr.Dataset({vn: (list(vn_coords.keys()), np.zeros([len(x) for x in vn_coords.values()]))}, 
+                                   coords=vn_coords)
+                ref_ds = vn_ds if ref_ds is None else xr.merge((ref_ds, vn_ds))
+            for vn in ref_ds.variables:
+                ref_ds.variables[vn].attrs = glacier_output.output_attrs_dict.get(vn, {})
+            for vn, value in [('RGIId', 'RGI60-15.00001'), ('CenLon', 86.), ('CenLat', 28.), ('O1Region', 15), 
+                              ('O2Region', 1), ('Area', 1e6)]:
+                ref_ds[vn].values = np.array([value])
+            ref_ds.attrs = output_ds.attrs
+            xr.testing.assert_identical(output_ds, ref_ds)
+            assert sorted(glacier_output.encoding) == sorted(vn for vn in output_ds.variables if vn != 'RGIId')
+
+
+def test_batch_output(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(output.pygem_prms, 'output_sim_fp', str(tmp_path) + '/')
+    monkeypatch.setattr(output.pygem_prms, 'option_calibration', None)
+    rng = np.random.default_rng(5)
+    dates_table = modelsetup.datesmodelrun(startyear=2000, endyear=2004, spinupyears=0, option_wateryear='calendar')
+    for sparse in [False, True]:
+        batch = output.batch_output('1', fn_suffix='binned.nc', glac_chunksize=2, sparse=sparse)
+        glacier_ds = []
+        for i, nbins in enumerate([5, 8, 3]):
+            glacier_output = output.binned_stats(rgi_series(i), dates_table, '1.0', 'CESM2', 'ssp245', None, 1, 
+                                                 {'kp': 1., 'ddfsnow': 0.004, 'tbias': 0., 'precgrad': 1e-4 * i}, 
+                                                 2000, 2000, 2004, nbins=nbins)
+            glacier_output.create_xr_ds()
+            glacier_output.get_xr_ds()['bin_thick_annual'].values = rng.random((1, nbins, 6))
+            glacier_ds.append(glacier_output.get_xr_ds().copy(deep=True))
+            batch.add(glacier_output)
+        batch.save()
+
+        # One file of the glaciers (padded to the largest number of bins) and its index
+        with xr.open_dataset(glacier_output.outdir + batch.get_fn()) as ds:
+            ds = output.dense_binned_ds(ds) if sparse else ds
+            assert ds.sizes['glac'] == 3 and ds.sizes['bin'] == 8
+            for i, ds_i in enumerate(glacier_ds):
+                nbins = ds_i.sizes['bin']
+                np.testing.assert_array_equal(ds['bin_thick_annual'].values[i,:nbins], ds_i['bin_thick_annual'].values[0])
+                assert np.isnan(ds['bin_thick_annual'].values[i,nbins:]).all()
+            assert json.loads(ds.attrs['run_parameters']) == json.loads(glacier_output.run_params)
+            assert 'model_parameters' not in ds.attrs
+        index = pd.read_csv(glacier_output.outdir + batch.get_fn().replace('.nc', '_index.csv'))
+        assert list(index['RGIId']) == ['RGI60-15.00001', 'RGI60-15.00002', 'RGI60-15.00003']
+        assert list(index['offset']) == [0, 1, 2] and (index['file'] == batch.get_fn()).all()
+        assert [json.loads(x)['precgrad'] for x in index['model_parameters']] == [0., 1e-4, 2e-4]
+
+
+def test_output_writer(tmp_path):
+
+    rng = np.random.default_rng(6)
+    datasets = [xr.Dataset({'glac_mass_annual': (('glac', 'year'), rng.random((3, 100)))}, 
+                           coords={'glac': np.arange(3), 'year': np.arange(100)}) for _ in range(60)]
+    encoding = {'glac_mass_annual': {'zlib': True, 'complevel': 4}}
+    datasets[0].to_netcdf(tmp_path / 'read.nc')
+    for use_processes, nworkers in [(True, 6), (False, 1)]:
+        with output.output_writer(nworkers=nworkers, max_queue=4, use_processes=use_processes) as writer:
+            for i, ds in enumerate(datasets):
+                writer.submit(ds, str(tmp_path / (str(i) + '.nc')), encoding)
+                # netCDF reads of the simulation while the writer processes work (the thread mode is only safe 
+                #  without netCDF reads and writes on other threads)
+                if use_processes:
+                    with xr.open_dataset(tmp_path / 'read.nc') as ds_read:
+                        ds_read.load()
+        for i, ds in enumerate(datasets):
+            with xr.open_dataset(tmp_path / (str(i) + '.nc')) as ds_written:
+                xr.testing.assert_identical(ds_written, ds)
+        with pytest.raises(RuntimeError):
+            writer.submit(datasets[0], str(tmp_path / 'closed.nc'), encoding)
+
+    # Errors of the writes are raised by flush
+    writer = output.output_writer(nworkers=2)
+    writer.submit(datasets[0], str(tmp_path / 'missing_dir' / '0.nc'), encoding)
+    with pytest.raises(OSError):
+        writer.flush()
+    writer.close()
+
+
+def test_read_output(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(output.pygem_prms, 'output_sim_fp', str(tmp_path) + '/')
+    rng = np.random.default_rng(4)
+    dates_table = modelsetup.datesmodelrun(startyear=2000, endyear=2004, spinupyears=0, option_wateryear='calendar')
+    # 3 single glacier files and a batch of 3 glaciers, whose label has an underscore
+    batch = output.batch_output('15_1-3')
+    mass = {}
+    for i in range(6):
+        glacier_rgi_table = rgi_series(i)
+        glacier_output = output.glacierwide_stats(glacier_rgi_table, dates_table, '1.0', 'CESM2', 'ssp245', None, 1, 
+                                                  {'kp': 1.}, 2000, 2000, 2004)
+        glacier_output.create_xr_ds()
+        glacier_ds = glacier_output.get_xr_ds()
+        glacier_ds['glac_mass_annual'].values = rng.random(glacier_ds['glac_mass_annual'].shape)
+        mass[glacier_rgi_table['RGIId']] = glacier_ds['glac_mass_annual'].values[0]
+        if i < 3:
+            glacier_output.save_xr_ds(glacier_output.get_fn() + 'all.nc')
+        else:
+            batch.add(glacier_output)
+    batch.save()
+    outdir = glacier_output.outdir
+
+    index = output.output_index(outdir)
+    assert len(index) == 6 and index['run'].nunique() == 1
+    rgiids = ['RGI60-15.00005', '15.00002', 'RGI60-15.00006', 'RGI60-15.00001']
+    output_ds = output.read_output(rgiids, outdir, vns=['glac_mass_annual'], nreaders=1)
+    assert list(output_ds['RGIId'].values) == ['RGI60-15.00005', 'RGI60-15.00002', 'RGI60-15.00006', 'RGI60-15.00001']
+    for k, rgiid in enumerate(output_ds['RGIId'].values):
+        np.testing.assert_allclose(output_ds['glac_mass_annual'].values[k], mass[rgiid])
+
+    # A batch rewritten in place (other order of the glaciers) is read with its new index
+    batch_index_fullfn = outdir + batch.get_fn().replace('.nc', '_index.csv')
+    batch_index_mtime = os.stat(batch_index_fullfn).st_mtime_ns
+    outdir_mtime = os.stat(outdir).st_mtime_ns
+    for i in [5, 3, 4]:
+        glacier_output = output.glacierwide_stats(rgi_series(i), dates_table, '1.0', 'CESM2', 'ssp245', None, 1, 
+                                                  {'kp': 1.}, 2000, 2000, 2004)
+        glacier_output.create_xr_ds()
+        glacier_output.get_xr_ds()['glac_mass_annual'].values = mass[rgi_series(i)['RGIId']][np.newaxis,:]
+        batch.add(glacier_output)
+    batch.save()
+    # files overwritten in place do not change the modification time of the directory
+    os.utime(outdir, ns=(outdir_mtime, outdir_mtime))
+    os.utime(batch_index_fullfn, ns=(batch_index_mtime + 10**9, batch_index_mtime + 10**9))
+    output_ds = output.read_output(rgiids, outdir, vns=['glac_mass_annual'], nreaders=1)
+    assert list(output_ds['RGIId'].values) == ['RGI60-15.00005', 'RGI60-15.00002', 'RGI60-15.00006', 'RGI60-15.00001']
+    for k, rgiid in enumerate(output_ds['RGIId'].values):
+        np.testing.assert_allclose(output_ds['glac_mass_annual'].values[k], mass[rgiid])
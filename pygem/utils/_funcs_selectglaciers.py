@@ -8,10 +8,15 @@ Functions of different ways to select glaciers
 
 # Built-in libraries
 import os
+import json
 import pickle 
 # External libraries
 import numpy as np
 import pandas as pd
+import shapely
+# Local libraries
+import pygem_input as pygem_prms
+import pygem.pygem_modelsetup as modelsetup
 
 #%% ----- Functions to select specific glacier numbers -----
 def get_same_glaciers(glac_fp, ending):
@@ -106,4 +111,246 @@ def glac_wo_cal(regions, prms_fp_sub=None, cal_option='MCMC'):
             if not cal_option in modelprms_dict.keys():
                 todo_list.append(glac_str)
                 
-    return todo_list 
\ No newline at end of file
+    return todo_list 
+
+
+#%% ----- Spatial selection of glaciers -----
+class GlacierSpatialIndex():
+    """
+    Grid spatial index of the RGI glacier centroids (CenLon, CenLat) for selecting glaciers by location
+    
+    Glaciers are sorted by grid cell, so the glaciers of each cell are a contiguous slice of the arrays and a query only 
+    checks the glaciers in the cells that overlap the query.
+
+    Attributes
+    ----------
+    glacno : np.array
+        glacier numbers (e.g., '1.00001')
+    cenlon, cenlat : np.array
+        longitude (-180 to 180) and latitude of the glacier centroids
+    watershed : np.array
+        watershed id of each glacier ('' if not assigned)
+    cell_size : float
+        size of the grid cells in degrees
+    """
+    def __init__(self, glacno, cenlon, cenlat, watershed=None, cell_size=1.):
+        self.cell_size = float(cell_size)
+        self.nlon = int(np.ceil(360 / self.cell_size))
+        self.nlat = int(np.ceil(180 / self.cell_size))
+        cenlon = np.asarray(cenlon, dtype=float)
+        cenlat = np.asarray(cenlat, dtype=float)
+        if watershed is None:
+            watershed = np.full(cenlon.shape, '')
+        # sort glaciers by grid cell
+        cell = self._cell_idx(cenlon, cenlat)
+        sort_idx = np.argsort(cell, kind='stable')
+        self.glacno = np.asarray(glacno).astype(str)[sort_idx]
+        self.cenlon = cenlon[sort_idx]
+        self.cenlat = cenlat[sort_idx]
+        self.watershed = np.asarray(watershed).astype(str)[sort_idx]
+        self.cells, self.cell_start = np.unique(cell[sort_idx], return_index=True)
+        self.cell_end = np.append(self.cell_start[1:], cell.shape[0])
+        self.source = None
+    
+    
+    def _cell_idx(self, lon, lat):
+        """ Grid cell of each longitude and latitude """
+        lat_idx = np.clip(np.floor((np.asarray(lat) + 90) / self.cell_size).astype(int), 0, self.nlat - 1)
+        lon_idx = np.clip(np.floor((np.asarray(lon) + 180) / self.cell_size).astype(int), 0, self.nlon - 1)
+        return lat_idx * self.nlon + lon_idx
+    
+    
+    def _bbox_idx(self, lon_min, lon_max, lat_min, lat_max):
+        """ Indices of the glaciers in the grid cells that overlap a bounding box (not crossing the dateline) """
+        cell_min, cell_max = self._cell_idx([lon_min, lon_max], [lat_min, lat_max])
+        lat_idx = np.arange(cell_min // self.nlon, cell_max // self.nlon + 1)
+        lon_idx = np.arange(cell_min % self.nlon, cell_max % self.nlon + 1)
+        cells = (lat_idx[:,np.newaxis] * self.nlon + lon_idx[np.newaxis,:]).ravel()
+        cells = cells[np.isin(cells, self.cells, assume_unique=True)]
+        cells_idx = np.searchsorted(self.cells, cells)
+        if cells_idx.shape[0] == 0:
+            return np.zeros(0, dtype=int)
+        glac_idx = np.concatenate([np.arange(self.cell_start[i], self.cell_end[i]) for i in cells_idx])
+        # glaciers in the bounding box
+        glac_idx = glac_idx[(self.cenlon[glac_idx] >= lon_min) & (self.cenlon[glac_idx] <= lon_max) & 
+                            (self.cenlat[glac_idx] >= lat_min) & (self.cenlat[glac_idx] <= lat_max)]
+        return glac_idx
+    
+    
+    def query_bbox(self, lon_min, lon_max, lat_min, lat_max):
+        """
+        Glaciers with centroids in a bounding box
+        
+        Parameters
+        ----------
+        lon_min, lon_max : float
+            longitude bounds (-180 to 180); lon_min > lon_max selects a box that crosses the dateline
+        lat_min, lat_max : float
+            latitude bounds
+        
+        Returns
+        -------
+        glac_no : list
+            list of glacier numbers, e.g., ['14.00001', '15.00001']
+        """
+        if lon_min <= lon_max:
+            glac_idx = self._bbox_idx(lon_min, lon_max, lat_min, lat_max)
+        else:
+            glac_idx = np.concatenate([self._bbox_idx(lon_min, 180, lat_min, lat_max), 
+                                       self._bbox_idx(-180, lon_max, lat_min, lat_max)])
+        return list(self.glacno[np.sort(glac_idx)])
+    
+    
+    def query_polygon(self, polygon):
+        """
+        Glaciers with centroids in a polygon
+        
+        Parameters
+        ----------
+        polygon : shapely.geometry.Polygon or MultiPolygon
+            polygon in longitude (-180 to 180) and latitude, e.g., a basin outline from a shapefile
+        
+        Returns
+        -------
+        glac_no : list
+            list of glacier numbers, e.g., ['14.00001', '15.00001']
+        """
+        lon_min, lat_min, lon_max, lat_max = polygon.bounds
+        glac_idx = np.sort(self._bbox_idx(lon_min, lon_max, lat_min, lat_max))
+        glac_idx = glac_idx[shapely.contains_xy(polygon, self.cenlon[glac_idx], self.cenlat[glac_idx])]
+        return list(self.glacno[glac_idx])
+    
+    
+    def query_watershed(self, watershed_ids):
+        """
+        Glaciers in precomputed watersheds
+        
+        Parameters
+        ----------
+        watershed_ids : list
+            list of watershed ids
+        
+        Returns
+        -------
+        glac_no : list
+            list of glacier numbers, e.g., ['14.00001', '15.00001']
+        """
+        glac_idx = np.where(np.isin(self.watershed, np.asarray(watershed_ids).astype(str)))[0]
+        return list(self.glacno[glac_idx])
+    
+    
+    def save(self, fullfn):
+        """ Save the spatial index as a numpy .npz file """
+        np.savez(fullfn, glacno=self.glacno, cenlon=self.cenlon, cenlat=self.cenlat, watershed=self.watershed,
+                 cell_size=self.cell_size, cells=self.cells, cell_start=self.cell_start, cell_end=self.cell_end,
+                 source=json.dumps(self.source))
+    
+    
+    @classmethod
+    def load(cls, fullfn):
+        """ Load a spatial index saved with save() """
+        spatialindex = cls.__new__(cls)
+        with np.load(fullfn) as ds:
+            for vn in ['glacno', 'cenlon', 'cenlat', 'watershed', 'cells', 'cell_start', 'cell_end']:
+                setattr(spatialindex, vn, ds[vn])
+            spatialindex.cell_size = float(ds['cell_size'])
+            spatialindex.source = json.loads(str(ds['source'])) if 'source' in ds else None
+        spatialindex.nlon = int(np.ceil(360 / spatialindex.cell_size))
+        spatialindex.nlat = int(np.ceil(180 / spatialindex.cell_size))
+        return spatialindex
+
+
+def glacier_spatialindex(rgi_regionsO1, spatialindex_fullfn=None, rgi_fp=pygem_prms.rgi_fp, 
+                         rgi_store_fp=None, watershed_fullfn=None, watershed_cn='watershed', cell_size=1.):
+    """
+    Spatial index of the glaciers in RGI order 1 regions, built once and saved to spatialindex_fullfn
+    
+    Parameters
+    ----------
+    rgi_regionsO1 : list of integers
+        list of integers of RGI order 1 regions (e.g., [1, 13])
+    spatialindex_fullfn : str
+        filename of the saved spatial index (.npz); loaded if it exists and was built with the same regions, cell size
+        and watersheds, and after the last change of the RGI csv files, RGI store and watershed file; otherwise built 
+        and saved
+    rgi_fp : str
+        filepath of the RGI csv files
+    rgi_store_fp : str
+        filepath of the indexed RGI store (see pygem_modelsetup.rgiregiontable)
+    watershed_fullfn : str
+        csv file with the precomputed watershed of each glacier (columns 'RGIId' and watershed_cn)
+    watershed_cn : str
+        column name of the watershed ids
+    cell_size : float
+        size of the grid cells in degrees
+    
+    Returns
+    -------
+    spatialindex : GlacierSpatialIndex
+        spatial index of the glacier centroids
+    """
+    source = {'rgi_regionsO1': sorted(int(region) for region in rgi_regionsO1), 'cell_size': float(cell_size),
+              'watershed_fullfn': watershed_fullfn, 'watershed_cn': watershed_cn if watershed_fullfn else None}
+    if spatialindex_fullfn is not None and os.path.exists(spatialindex_fullfn):
+        spatialindex = GlacierSpatialIndex.load(spatialindex_fullfn)
+        # files the spatial index is built from
+        source_fns = [watershed_fullfn] if watershed_fullfn is not None else []
+        for region in source['rgi_regionsO1']:
+            for rgi_fn in os.listdir(rgi_fp):
+                if rgi_fn.startswith(str(region).zfill(2)) and rgi_fn.endswith('.csv'):
+                    source_fns.append(rgi_fp + rgi_fn)
+                    if rgi_store_fp is not None:
+                        source_fns.append(modelsetup.rgi_store_fullfn(rgi_fn, rgi_store_fp))
+        spatialindex_mtime = os.path.getmtime(spatialindex_fullfn)
+        if (spatialindex.source == source and 
+            all(os.path.getmtime(fn) <= spatialindex_mtime for fn in source_fns if os.path.exists(fn))):
+            return spatialindex
+    
+    rgi_table = pd.concat([modelsetup.rgiregiontable(region, rgi_fp=rgi_fp, rgi_store_fp=rgi_store_fp)
+                           for region in sorted(rgi_regionsO1)], axis=0)
+    watershed = None
+    if watershed_fullfn is not None:
+        watershed_df = pd.read_csv(watershed_fullfn)
+        watershed_idx = pd.Index(watershed_df['RGIId']).get_indexer(rgi_table['RGIId'])
+        watershed = np.where(watershed_idx >= 0, watershed_df[watershed_cn].values.astype(str)[watershed_idx], '')
+    spatialindex = GlacierSpatialIndex(rgi_table['glacno'].values, rgi_table['CenLon'].values, 
+                                       rgi_table['CenLat'].values, watershed=watershed, cell_size=cell_size)
+    spatialindex.source = source
+    if spatialindex_fullfn is not None:
+        spatialindex.save(spatialindex_fullfn)
+    return spatialindex
+
+
+def _glacier_table(glac_no, **kwargs):
+    """ Glacier table of a list of glaciers (see pygem_modelsetup.selectglaciersrgitable); empty if there are none """
+    if len(glac_no) == 0:
+        return pd.DataFrame()
+    return modelsetup.selectglaciersrgitable(glac_no=glac_no, **kwargs)
+
+
+def glac_frombbox(spatialindex, lon_min, lon_max, lat_min, lat_max, **kwargs):
+    """
+    Glacier table of the glaciers with centroids in a bounding box (see GlacierSpatialIndex.query_bbox)
+    
+    The keyword arguments (e.g., rgi_fp, rgi_store_fp, include_tidewater, min_glac_area_km2) are passed to 
+    pygem_modelsetup.selectglaciersrgitable, which returns the table.
+    """
+    return _glacier_table(spatialindex.query_bbox(lon_min, lon_max, lat_min, lat_max), **kwargs)
+
+
+def glac_frompolygon(spatialindex, polygon, **kwargs):
+    """
+    Glacier table of the glaciers with centroids in a polygon (see GlacierSpatialIndex.query_polygon)
+    
+    The keyword arguments are passed to pygem_modelsetup.selectglaciersrgitable, which returns the table.
+    """
+    return _glacier_table(spatialindex.query_polygon(polygon), **kwargs)
+
+
+def glac_fromwatershed(spatialindex, watershed_ids, **kwargs):
+    """
+    Glacier table of the glaciers in precomputed watersheds (see GlacierSpatialIndex.query_watershed)
+    
+    The keyword arguments are passed to pygem_modelsetup.selectglaciersrgitable, which returns the table.
+    """
+    return _glacier_table(spatialindex.query_watershed(watershed_ids), **kwargs)